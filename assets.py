@@ -0,0 +1,47 @@
+# assets.py
+#
+# Static asset bundles.  build_assets.py concatenates and minifies the
+# sources of each bundle into static/<name>.<content hash>.<ext> and lists
+# the built files in asset_manifest.json.  app.yaml serves static/ with a
+# one-year expiration: a changed bundle gets a new name, so browsers never
+# need to revalidate one.  Templates link a bundle through asset_urls(),
+# which falls back to the separate sources on the dev server or when the
+# bundles have not been built.
+
+import json
+import os
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BUILD_DIR = 'static'
+MANIFEST_PATH = os.path.join(ROOT, 'asset_manifest.json')
+
+# Bundle name -> the files it is built from, in order.  Only assets the
+# templates actually load belong here; the CDN libraries stay on the CDN.
+BUNDLES = {
+    'site.css': ['stylesheets/main.css'],
+    'discussion.js': ['js/jquery.zoom.min.js'],
+}
+
+DEVELOPMENT = os.environ.get('SERVER_SOFTWARE', '').startswith('Development')
+
+
+def load_manifest(path=MANIFEST_PATH):
+    """Return {bundle name: built file path}, empty if nothing was built."""
+    try:
+        with open(path) as manifest:
+            return json.load(manifest)
+    except (IOError, ValueError):
+        return {}
+
+
+# Edited sources show up on the dev server without a rebuild
+_manifest = {} if DEVELOPMENT else load_manifest()
+
+
+def asset_urls(bundle):
+    """Return the URLs a page loads for a bundle: the built file or its sources."""
+    built = _manifest.get(bundle)
+    if built:
+        return ['/' + built]
+    return ['/' + source for source in BUNDLES[bundle]]
@@ -0,0 +1,441 @@
+# benchmark.py
+#
+# Local benchmark of the medReach handlers against the App Engine testbed
+# stubs.  Seeds a datastore of discussions, comments, replies and photos,
+# then drives each route in-process through guestbook.app.get_response and
+# reports, per route, latency percentiles, API calls per request, datastore
+# bytes read and template render time as JSON.  Compare two revisions with
+#
+#   python benchmark.py --sdk ~/google_appengine --output before.json
+#   python benchmark.py --sdk ~/google_appengine --baseline before.json
+#
+# --cold-starts N also times importing the app and serving its first request
+# in N fresh processes, and --dataset DIR benchmarks a dump made by
+# bulk_data.py instead of the generated data.
+
+import argparse
+import json
+import os
+import struct
+import subprocess
+import sys
+import time
+import zlib
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+USER_EMAIL = 'bench@example.com'
+USER_ID = '100000000000000000001'
+
+# Datastore calls whose responses carry entity data
+DATASTORE_READS = ('Get', 'RunQuery', 'Next')
+
+
+def tiny_png(width=8, height=8):
+    """Return the bytes of a small solid PNG, to seed photos and avatars."""
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+    rows = ''.join('\x00' + '\x80\x40\x20' * width for _ in range(height))
+    return ('\x89PNG\r\n\x1a\n' +
+            chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            chunk('IDAT', zlib.compress(rows)) +
+            chunk('IEND', ''))
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    index = max(0, int(round(fraction * len(ordered) + 0.5)) - 1)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def setup_sdk(sdk_path):
+    """Put the App Engine SDK and its bundled libraries on sys.path."""
+    if sdk_path:
+        sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, REPO_DIR)
+
+
+class Recorder(object):
+    """Collects API calls and template render time for the current request."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = {}
+        self.datastore_bytes = 0
+        self.template_seconds = 0.0
+
+    def after_call(self, service, call, request, response):
+        name = '%s.%s' % (service, call)
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if service == 'datastore_v3' and call in DATASTORE_READS:
+            self.datastore_bytes += response.ByteSize()
+
+
+class TimedTemplate(object):
+    """Wraps a jinja2 template to add its render time to a Recorder."""
+
+    def __init__(self, template, recorder):
+        self._template = template
+        self._recorder = recorder
+
+    def render(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return self._template.render(*args, **kwargs)
+        finally:
+            self._recorder.template_seconds += time.time() - start
+
+
+class Benchmark(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.recorder = Recorder()
+
+    def activate(self):
+        self.init_stubs()
+        self.load_app()
+
+    def init_stubs(self):
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import testbed
+
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_memcache_stub()
+        self.testbed.init_user_stub()
+        self.testbed.init_images_stub()
+        self.testbed.init_blobstore_stub()
+        self.testbed.init_mail_stub()
+        self.testbed.init_search_stub()
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_urlfetch_stub()
+        # queue.yaml declares the named queues the handlers use
+        self.testbed.init_taskqueue_stub(root_path=REPO_DIR)
+        self.login(admin=True)
+
+    def load_app(self):
+        from google.appengine.api import apiproxy_stub_map
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'benchmark', self.recorder.after_call)
+
+        import guestbook
+        self.guestbook = guestbook
+        environment = guestbook.JINJA_ENVIRONMENT
+        get_template = environment.get_template
+        environment.get_template = lambda *args, **kwargs: TimedTemplate(
+            get_template(*args, **kwargs), self.recorder)
+
+    def deactivate(self):
+        self.testbed.deactivate()
+
+    def login(self, admin=False):
+        self.testbed.setup_env(user_email=USER_EMAIL, user_id=USER_ID,
+                               user_is_admin='1' if admin else '0', overwrite=True)
+
+    def logout(self):
+        self.testbed.setup_env(user_email='', user_id='', user_is_admin='0',
+                               overwrite=True)
+
+    def seed(self):
+        """Create the discussions, comments, replies, photos and avatar to read."""
+        from google.appengine.ext import ndb
+        if self.options.dataset:
+            self.seed_from_dump(self.options.dataset)
+            return
+        gb = self.guestbook
+        png = tiny_png()
+        author = gb.Author(identity=USER_ID, email=USER_EMAIL)
+        self.discussion_keys, self.greeting_keys, self.photo_keys = [], [], []
+
+        # Outside a request, so not through the request-memoized get_mr_user
+        mr_user = gb.MrUser.get_or_insert(USER_ID, userid=USER_ID)
+        mr_user.avatar = mr_user.avatar_64 = png
+        mr_user.put()
+
+        def add_comment(parent, discussion_key, index, subcomment):
+            greeting = gb.Greeting(parent=parent, author=author, upvotes=0, downvotes=0,
+                                   subcomment=subcomment,
+                                   content='Benchmark opinion %d about treatment options' % index)
+            gb.add_comment_async(greeting, discussion_key).get_result()
+            gb.count_async('num_comments', discussion_key).get_result()
+            self.greeting_keys.append(greeting.key)
+            for _ in range(self.options.photos):
+                photo = gb.new_photo(greeting.key, png)
+                self.photo_keys.append(
+                    gb.attach_photo_async(photo, greeting.key, discussion_key).get_result())
+            return greeting
+
+        for index in range(self.options.discussions):
+            discussion = gb.Discussion(
+                title='Benchmark request %d' % index,
+                content='Patient presents with symptoms described in request %d' % index,
+                medical_category=gb.MEDICAL_CATEGORIES[index % len(gb.MEDICAL_CATEGORIES)],
+                owner=gb.Owner(identity=USER_ID, email=USER_EMAIL),
+                upvotes=0, downvotes=0, num_comments=0)
+            key = gb.save_discussion(discussion)
+            self.discussion_keys.append(key)
+            for comment in range(self.options.comments):
+                greeting = add_comment(key, key, comment, False)
+                for reply in range(self.options.replies):
+                    add_comment(greeting.key, key, reply, True)
+            self.request('POST', '/tasks/index_post',
+                         {'key': key.urlsafe(), 'cascade': '1'})
+        ndb.get_context().clear_cache()
+
+    def seed_from_dump(self, location):
+        """Import a bulk export and pick the keys to read from it."""
+        from google.appengine.ext import ndb
+        import bulk
+        gb = self.guestbook
+        bulk.run_import(location)
+        gb.MrUser.get_or_insert(USER_ID, userid=USER_ID)
+        self.discussion_keys = gb.Discussion.query().order(-gb.Discussion.date).fetch(
+            self.options.discussions, keys_only=True)
+        self.greeting_keys = gb.Greeting.query().fetch(1000, keys_only=True)
+        self.photo_keys = gb.Photo.query().fetch(1000, keys_only=True)
+        for key in self.discussion_keys:
+            self.request('POST', '/tasks/index_post',
+                         {'key': key.urlsafe(), 'cascade': '1'})
+        ndb.get_context().clear_cache()
+
+    def request(self, method, path, params=None):
+        """Drive one request through the app; returns the response."""
+        from google.appengine.ext import ndb
+        # Every real request starts with an empty ndb in-context cache
+        ndb.get_context().clear_cache()
+        if method == 'POST':
+            return self.guestbook.app.get_response(path, method='POST', POST=params or {})
+        return self.guestbook.app.get_response(path)
+
+    def scenarios(self):
+        """Return (name, logged_in, method, path, params) per benchmarked route.
+
+        Paths and params are callables of the iteration number, so writes act
+        on a different comment each time.  Blobstore upload handlers need a
+        real upload and are left out.
+        """
+        discussion = self.discussion_keys[0].urlsafe()
+        greetings = self.greeting_keys
+        photos = self.photo_keys
+
+        def greeting(iteration):
+            return greetings[iteration % len(greetings)]
+
+        def discussion_of(key):
+            return self.guestbook.ndb.Key(pairs=key.pairs()[:1]).urlsafe()
+
+        return [
+            ('front_page', False, 'GET', lambda i: '/', None),
+            ('front_page_active', False, 'GET', lambda i: '/?sort=active', None),
+            ('front_page_hot', False, 'GET', lambda i: '/?sort=hot', None),
+            ('front_page_category', False, 'GET',
+             lambda i: '/?category=' + self.guestbook.MEDICAL_CATEGORIES[1], None),
+            ('front_page_logged_in', True, 'GET', lambda i: '/', None),
+            ('discussion', False, 'GET',
+             lambda i: '/discussion?discussion_key=' + discussion, None),
+            ('discussion_logged_in', True, 'GET',
+             lambda i: '/discussion?discussion_key=' + discussion, None),
+            ('photo_thumb', False, 'GET',
+             lambda i: '/photo?size=thumb&photo_key=' + photos[i % len(photos)].urlsafe()
+             if photos else '/photo', None),
+            ('avatar', False, 'GET',
+             lambda i: '/img?img_id=' + greeting(i).urlsafe(), None),
+            ('search', False, 'GET', lambda i: '/search?q=treatment', None),
+            ('settings', True, 'GET', lambda i: '/settings', None),
+            ('upload_urls', True, 'GET', lambda i: '/upload_urls?count=3', None),
+            ('post_comment', True, 'POST',
+             lambda i: '/sign?parent=discussion&key=%s&discussion_key=%s' % (discussion, discussion),
+             lambda i: {'content': 'Benchmark follow-up %d' % i}),
+            ('vote', True, 'POST', lambda i: '/vote',
+             lambda i: {'greeting_key': greeting(i).urlsafe(),
+                        'discussion_key': discussion_of(greeting(i)),
+                        'vote_type': 'up'}),
+            ('update_discussion', True, 'POST',
+             lambda i: '/update?discussion_key=' + discussion,
+             lambda i: {'content': 'Updated description %d' % i}),
+            ('post_discussion', True, 'POST', lambda i: '/post_new',
+             lambda i: {'disc-title': 'Benchmark new request %d' % i,
+                        'content': 'New request body', 'medical-category': 'cardiology'}),
+        ]
+
+    def run_scenario(self, logged_in, method, path, params):
+        from google.appengine.api import memcache
+        if logged_in:
+            self.login()
+        else:
+            self.logout()
+
+        samples = []
+        for iteration in range(self.options.iterations):
+            if self.options.cold:
+                memcache.flush_all()
+            self.recorder.reset()
+            start = time.time()
+            response = self.request(method, path(iteration),
+                                    params(iteration) if params else None)
+            elapsed = time.time() - start
+            samples.append({
+                'seconds': elapsed,
+                'status': response.status_int,
+                'calls': dict(self.recorder.calls),
+                'datastore_bytes': self.recorder.datastore_bytes,
+                'template_seconds': self.recorder.template_seconds,
+            })
+        return summarize(samples)
+
+    def run(self):
+        self.activate()
+        try:
+            self.seed()
+            results = {}
+            for name, logged_in, method, path, params in self.scenarios():
+                results[name] = self.run_scenario(logged_in, method, path, params)
+            return results
+        finally:
+            self.deactivate()
+
+
+def summarize(samples):
+    """Reduce per-request samples to the reported statistics of one route."""
+    count = len(samples)
+    latencies = [sample['seconds'] * 1000 for sample in samples]
+    calls = {}
+    statuses = {}
+    for sample in samples:
+        for name, number in sample['calls'].items():
+            calls[name] = calls.get(name, 0) + number
+        statuses[str(sample['status'])] = statuses.get(str(sample['status']), 0) + 1
+    return {
+        'requests': count,
+        'status': statuses,
+        'latency_ms': {
+            'mean': round(sum(latencies) / count, 3),
+            'p50': round(percentile(latencies, 0.5), 3),
+            'p90': round(percentile(latencies, 0.9), 3),
+            'p99': round(percentile(latencies, 0.99), 3),
+            'max': round(max(latencies), 3),
+        },
+        'calls_per_request': dict((name, round(float(number) / count, 2))
+                                  for name, number in sorted(calls.items())),
+        'datastore_rpcs_per_request': round(float(sum(
+            number for name, number in calls.items()
+            if name.startswith('datastore_v3.'))) / count, 2),
+        'datastore_bytes_read': sum(sample['datastore_bytes'] for sample in samples) // count,
+        'template_ms': round(sum(sample['template_seconds'] for sample in samples) * 1000 / count, 3),
+    }
+
+
+def cold_start_child(options):
+    """Time importing the app and its first request in this fresh process."""
+    # Take the deployed code path, e.g. precompiled templates
+    os.environ['SERVER_SOFTWARE'] = 'Google App Engine/benchmark'
+    bench = Benchmark(options)
+    bench.init_stubs()
+    start = time.time()
+    bench.load_app()
+    loaded = time.time()
+    bench.request('GET', '/')
+    served = time.time()
+    json.dump({'import_ms': (loaded - start) * 1000,
+               'first_request_ms': (served - loaded) * 1000}, sys.stdout)
+
+
+def cold_starts(options):
+    """Run cold_start_child in new processes and summarize their timings."""
+    command = [sys.executable, os.path.abspath(__file__), '--cold-start-child']
+    if options.sdk:
+        command.extend(['--sdk', options.sdk])
+    samples = [json.loads(subprocess.check_output(command))
+               for _ in range(options.cold_starts)]
+    result = {'processes': len(samples)}
+    for name in ('import_ms', 'first_request_ms'):
+        values = [sample[name] for sample in samples]
+        result[name] = {'p50': round(percentile(values, 0.5), 3),
+                        'max': round(max(values), 3)}
+    return result
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, report, out):
+    """Write the per-route change in p50 latency and datastore RPCs."""
+    for name, result in sorted(report['results'].items()):
+        before = baseline.get('results', {}).get(name)
+        if not before:
+            continue
+        out.write('%-24s p50 %8.2f -> %8.2f ms   datastore rpcs %6.2f -> %6.2f\n' % (
+            name, before['latency_ms']['p50'], result['latency_ms']['p50'],
+            before['datastore_rpcs_per_request'], result['datastore_rpcs_per_request']))
+    if 'cold_start' in baseline and 'cold_start' in report:
+        for name in ('import_ms', 'first_request_ms'):
+            out.write('cold start %-13s p50 %8.2f -> %8.2f ms\n' % (
+                name, baseline['cold_start'][name]['p50'], report['cold_start'][name]['p50']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the medReach handlers on the testbed stubs.')
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--discussions', type=int, default=20)
+    parser.add_argument('--comments', type=int, default=10,
+                        help='top-level comments per discussion')
+    parser.add_argument('--replies', type=int, default=3,
+                        help='replies per comment')
+    parser.add_argument('--photos', type=int, default=1,
+                        help='photos per comment and reply')
+    parser.add_argument('--iterations', type=int, default=20,
+                        help='requests per route')
+    parser.add_argument('--dataset',
+                        help='bulk export to import instead of generating discussions')
+    parser.add_argument('--cold', action='store_true',
+                        help='flush memcache before every request')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--baseline', help='JSON report of an earlier revision to compare with')
+    parser.add_argument('--cold-starts', type=int, default=0,
+                        help='also time this many fresh-process imports and first requests')
+    parser.add_argument('--cold-start-child', action='store_true', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    setup_sdk(options.sdk)
+    if options.cold_start_child:
+        cold_start_child(options)
+        return
+
+    report = {
+        'revision': revision(),
+        'config': dict((name, getattr(options, name)) for name in
+                       ('discussions', 'comments', 'replies', 'photos', 'iterations', 'cold',
+                        'dataset')),
+        'results': Benchmark(options).run(),
+    }
+    if options.cold_starts:
+        report['cold_start'] = cold_starts(options)
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            compare(json.load(baseline), report, sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# build_assets.py
+#
+# Build step: bundle, minify and fingerprint the static assets listed in
+# assets.BUNDLES.  Each bundle is written to static/ under a name carrying a
+# hash of its content, and asset_manifest.json maps bundle names to those
+# files for assets.asset_urls.  Run it before each deploy, next to
+# compile_templates.py:
+#
+#   python build_assets.py
+
+import hashlib
+import json
+import os
+import re
+
+import assets
+
+
+HASH_LENGTH = 10
+
+_css_comment = re.compile(r'/\*(?!!).*?\*/', re.DOTALL)
+_css_space = re.compile(r'\s+')
+_css_punctuation = re.compile(r'\s*([{};,>])\s*')
+_css_url = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+
+def _absolute_urls(css, source):
+    """Point relative url()s at the source's directory, as the bundle lives elsewhere."""
+    directory = '/' + os.path.dirname(source)
+
+    def absolute(match):
+        quote, url = match.group(1), match.group(2)
+        if not re.match(r'(?:[a-z]+:|/|#)', url):
+            url = '%s/%s' % (directory, url)
+        return 'url(%s%s%s)' % (quote, url, quote)
+    return _css_url.sub(absolute, css)
+
+
+def minify_css(css):
+    """Strip comments and the whitespace CSS does not need.
+
+    Spaces before ':' are kept, as they matter in selectors ('a :hover').
+    """
+    css = _css_comment.sub('', css)
+    css = _css_space.sub(' ', css)
+    css = _css_punctuation.sub(r'\1', css)
+    css = css.replace(': ', ':').replace(';}', '}')
+    return css.strip()
+
+
+def build_bundle(name, sources):
+    """Return the minified content of a bundle."""
+    parts = []
+    for source in sources:
+        with open(os.path.join(assets.ROOT, source)) as f:
+            content = f.read()
+        if name.endswith('.css'):
+            parts.append(minify_css(_absolute_urls(content, source)))
+        else:
+            # Scripts are bundled from their .min.js releases as they are
+            parts.append(content.strip().rstrip(';') + ';')
+    return '\n'.join(parts) + '\n'
+
+
+def main():
+    build_dir = os.path.join(assets.ROOT, assets.BUILD_DIR)
+    if not os.path.isdir(build_dir):
+        os.makedirs(build_dir)
+
+    manifest = {}
+    for name, sources in sorted(assets.BUNDLES.items()):
+        content = build_bundle(name, sources)
+        base, ext = os.path.splitext(name)
+        digest = hashlib.md5(content).hexdigest()[:HASH_LENGTH]
+        path = '%s/%s.%s%s' % (assets.BUILD_DIR, base, digest, ext)
+        with open(os.path.join(assets.ROOT, path), 'wb') as f:
+            f.write(content)
+        manifest[name] = path
+        source_size = sum(os.path.getsize(os.path.join(assets.ROOT, source))
+                          for source in sources)
+        print '%s: %d files, %d -> %d bytes' % (path, len(sources), source_size, len(content))
+
+    # Drop bundles of earlier builds, which no deployed page links any more
+    built = set(os.path.basename(path) for path in manifest.values())
+    for filename in os.listdir(build_dir):
+        if filename not in built:
+            os.remove(os.path.join(build_dir, filename))
+
+    with open(assets.MANIFEST_PATH, 'w') as f:
+        json.dump(manifest, f, indent=2, separators=(',', ': '), sort_keys=True)
+        f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
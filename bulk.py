@@ -0,0 +1,418 @@
+# bulk.py
+#
+# Streaming export and import of medReach data.  An export is a directory,
+# local or gs://bucket/path, holding one NDJSON file per batch of each kind,
+#
+#   Discussion/000000.ndjson, Greeting/000000.ndjson, ...
+#
+# with one {"key": [kind, id, ...], "properties": {...}} object per line,
+# plus the blob and image bytes as side-car files under blobs/, named by
+# their SHA-1.  Keys keep their full ancestry but no application id, so a
+# dump loads into any app.  Each batch is one keys-only cursor query and a
+# get_multi (export) or put_multi (import) of BATCH_SIZE entities, fewer for
+# images and put a few megabytes at a time, so memory stays flat however
+# big the datastore is, and every finished batch writes a checkpoint to
+# resume from.
+#
+# The same batches run as a chain of tasks in production (/admin/export,
+# /admin/import) or in one process against the datastore stub, see
+# bulk_data.py and benchmark.py --dataset.  Sharded counter totals are
+# folded into the exported fields.  Blobstore originals cannot be written
+# back, so imported photos keep their bytes in Photo.data, and an import
+# stops at a photo whose original does not fit rather than lose it.
+
+import hashlib
+import json
+import os
+import posixpath
+import time
+from datetime import datetime
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+
+import webapp2
+
+import counters
+
+
+# In import order; summaries are exported so the front page works at once,
+# and votes so nobody can vote twice on an imported comment
+EXPORT_KINDS = ['Discussion', 'DiscussionSummary', 'Greeting', 'Photo', 'PhotoRendition',
+                'MrUser', 'CommentVote', 'ThreadChange']
+
+# Fields kept in sharded counters on top of the stored property
+COUNTED_FIELDS = {
+    'Discussion': ('num_comments',),
+    'Greeting': ('upvotes', 'downvotes'),
+    'MrUser': ('upvotes', 'downvotes', 'num_comments'),
+}
+
+# Entities per batch, which is per NDJSON file
+BATCH_SIZE = 100
+
+# Image entities hold up to 1MB each, so fewer of them make a batch
+IMAGE_KINDS = ('Photo', 'PhotoRendition')
+IMAGE_BATCH_SIZE = 8
+
+# Most bytes of entities put at once on import, inside the datastore's
+# request limit and an instance's memory
+PUT_BATCH_BYTES = 8 * 1024 * 1024
+
+QUEUE_NAME = 'bulk'
+
+EXPORT_CHECKPOINT = 'export_checkpoint.json'
+IMPORT_CHECKPOINT = 'import_checkpoint.json'
+
+# Largest photo original stored inline on import, inside the entity limit
+MAX_PHOTO_BYTES = 900 * 1024
+
+_DATE_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+
+def _is_gcs(path):
+    return path.startswith('gs://')
+
+
+def _open(path, mode='r'):
+    """Open a file of a dump, on local disk or in Cloud Storage."""
+    if _is_gcs(path):
+        import cloudstorage
+        return cloudstorage.open(path[len('gs:/'):], mode)
+    if mode == 'w' and not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    return open(path, mode + 'b')
+
+
+def _exists(path):
+    if _is_gcs(path):
+        import cloudstorage
+        try:
+            cloudstorage.stat(path[len('gs:/'):])
+        except cloudstorage.NotFoundError:
+            return False
+        return True
+    return os.path.exists(path)
+
+
+def part_path(location, kind, part):
+    return posixpath.join(location, kind, '%06d.ndjson' % part)
+
+
+def read_checkpoint(location, name):
+    """Return the checkpoint saved in a dump, or None."""
+    path = posixpath.join(location, name)
+    if not _exists(path):
+        return None
+    with _open(path) as f:
+        return json.load(f)
+
+
+def write_checkpoint(location, name, checkpoint):
+    with _open(posixpath.join(location, name), 'w') as f:
+        json.dump(checkpoint or {'done': True}, f)
+
+
+def _parse_date(value):
+    for date_format in _DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ValueError('Not an exported date: %r' % value)
+
+
+class _BlobWriter(object):
+    """Stores bytes as side-car files named by their hash, each once."""
+
+    def __init__(self, location):
+        self.location = location
+
+    def __call__(self, data):
+        name = hashlib.sha1(data).hexdigest()
+        path = posixpath.join(self.location, 'blobs', name)
+        if not _exists(path):
+            with _open(path, 'w') as f:
+                f.write(data)
+        return name
+
+
+class _BlobReader(object):
+
+    def __init__(self, location):
+        self.location = location
+
+    def __call__(self, name):
+        with _open(posixpath.join(self.location, 'blobs', name)) as f:
+            return f.read()
+
+
+def _encode_value(prop, value, write_blob):
+    if value is None:
+        return None
+    if isinstance(prop, ndb.StructuredProperty):
+        return _encode_properties(value, write_blob)
+    if isinstance(prop, ndb.DateTimeProperty):
+        return value.isoformat()
+    if isinstance(prop, ndb.KeyProperty):
+        return list(value.flat())
+    if isinstance(prop, ndb.BlobKeyProperty):
+        try:
+            return {'blob': write_blob(blobstore.BlobReader(value).read())}
+        except blobstore.Error:
+            # The blob was deleted from under its entity
+            return None
+    if type(prop) is ndb.BlobProperty:
+        return {'blob': write_blob(value)}
+    return value
+
+
+def _encode_properties(entity, write_blob):
+    properties = {}
+    for name, prop in entity._properties.items():
+        value = prop._get_value(entity)
+        if prop._repeated:
+            properties[name] = [_encode_value(prop, item, write_blob) for item in value]
+        else:
+            properties[name] = _encode_value(prop, value, write_blob)
+    return properties
+
+
+def _decode_value(prop, value, read_blob):
+    if value is None:
+        return None
+    if isinstance(prop, ndb.StructuredProperty):
+        return prop._modelclass(**_decode_properties(prop._modelclass, value, read_blob)[0])
+    if isinstance(prop, ndb.DateTimeProperty):
+        return _parse_date(value)
+    if isinstance(prop, ndb.KeyProperty):
+        return ndb.Key(flat=value)
+    if type(prop) is ndb.BlobProperty:
+        return read_blob(value['blob'])
+    return value
+
+
+def _decode_properties(model, properties, read_blob):
+    """Return (property values, {name: blob name} of blobstore originals)."""
+    values = {}
+    originals = {}
+    for name, value in properties.items():
+        prop = model._properties.get(name)
+        if prop is None:
+            continue
+        if isinstance(prop, ndb.BlobKeyProperty):
+            if value:
+                originals[name] = value['blob']
+        elif prop._repeated:
+            values[name] = [_decode_value(prop, item, read_blob) for item in value or []]
+        else:
+            values[name] = _decode_value(prop, value, read_blob)
+    return values, originals
+
+
+def _entity_from_record(model, record, read_blob):
+    values, originals = _decode_properties(model, record['properties'], read_blob)
+    entity = model(key=ndb.Key(flat=record['key']), **values)
+    # The original goes back inline, as the blobstore cannot be written to;
+    # photos from before renditions are served the same way
+    if model._get_kind() == 'Photo' and not entity.data and 'original' in originals:
+        data = read_blob(originals['original'])
+        if len(data) > MAX_PHOTO_BYTES:
+            raise ValueError('Photo %r has a %d byte original, over the %d bytes that fit inline'
+                             % (record['key'], len(data), MAX_PHOTO_BYTES))
+        entity.data = data
+        entity.digest = originals['original']
+    # Counted against the hot_votes counter, which import_batch() restarts
+    if model._get_kind() == 'DiscussionSummary':
+        entity.hot_votes = 0
+    return entity
+
+
+def export_batch(location, kind, cursor=None, part=0):
+    """Export one batch of a kind to a dump; return the next checkpoint.
+
+    The checkpoint is the keyword arguments of the next call, or None once
+    every kind is exported, and is also saved in the dump for resuming.
+    """
+    # guestbook defines the models and counters, and imports this module
+    import guestbook
+
+    query = ndb.Query(kind=kind)
+    start = ndb.Cursor(urlsafe=cursor) if cursor else None
+    batch_size = IMAGE_BATCH_SIZE if kind in IMAGE_KINDS else BATCH_SIZE
+    keys, next_cursor, more = query.fetch_page(batch_size, start_cursor=start, keys_only=True)
+    entities = [entity for entity in ndb.get_multi(keys) if entity]
+
+    fields = COUNTED_FIELDS.get(kind)
+    totals = guestbook.counter_totals(entities, *fields) if fields else {}
+    write_blob = _BlobWriter(location)
+    with _open(part_path(location, kind, part), 'w') as f:
+        for entity in entities:
+            properties = _encode_properties(entity, write_blob)
+            properties.update(totals.get(entity.key, {}))
+            f.write(json.dumps({'key': list(entity.key.flat()), 'properties': properties}))
+            f.write('\n')
+
+    if more and next_cursor:
+        checkpoint = {'kind': kind, 'cursor': next_cursor.urlsafe(), 'part': part + 1}
+    elif kind != EXPORT_KINDS[-1]:
+        checkpoint = {'kind': EXPORT_KINDS[EXPORT_KINDS.index(kind) + 1]}
+    else:
+        checkpoint = None
+    write_checkpoint(location, EXPORT_CHECKPOINT, checkpoint)
+    return checkpoint
+
+
+def _put_batches(entities):
+    """Put entities in batches of at most PUT_BATCH_BYTES; return their keys."""
+    keys = []
+    batch, batch_bytes = [], 0
+    for entity in entities:
+        size = entity._to_pb().ByteSize()
+        if batch and batch_bytes + size > PUT_BATCH_BYTES:
+            keys.extend(ndb.put_multi(batch, use_cache=False))
+            batch, batch_bytes = [], 0
+        batch.append(entity)
+        batch_bytes += size
+    if batch:
+        keys.extend(ndb.put_multi(batch, use_cache=False))
+    return keys
+
+
+def import_batch(location, kind, part=0):
+    """Import one NDJSON file of a dump; return the next checkpoint.
+
+    Puts overwrite by key, so a batch can be imported again safely; the
+    counters of imported entities are reset, as their totals are in the
+    imported fields.  Entities are read and put a few megabytes at a time.
+    """
+    import guestbook
+
+    path = part_path(location, kind, part)
+    if _exists(path):
+        model = ndb.Model._lookup_model(kind)
+        read_blob = _BlobReader(location)
+        with _open(path) as f:
+            keys = _put_batches(_entity_from_record(model, json.loads(line), read_blob)
+                                for line in f if line.strip())
+        fields = COUNTED_FIELDS.get(kind, ())
+        names = [guestbook.counter_name(field, key) for key in keys for field in fields]
+        if kind == 'DiscussionSummary':
+            # Imported summaries have no votes waiting to be folded into
+            # their hot score, so their discussions' vote counters restart
+            names.extend(guestbook.counter_name('hot_votes', key.parent()) for key in keys)
+        counters.delete_async(names).get_result()
+        checkpoint = {'kind': kind, 'part': part + 1}
+    elif kind != EXPORT_KINDS[-1]:
+        checkpoint = {'kind': EXPORT_KINDS[EXPORT_KINDS.index(kind) + 1]}
+    else:
+        checkpoint = None
+        guestbook.bump_cache_version(guestbook.FRONT_PAGE_SCOPE)
+    write_checkpoint(location, IMPORT_CHECKPOINT, checkpoint)
+    return checkpoint
+
+
+def _start(location, checkpoint_name, resume):
+    checkpoint = read_checkpoint(location, checkpoint_name) if resume else None
+    if checkpoint is None:
+        return {'kind': EXPORT_KINDS[0]}
+    if checkpoint.get('done'):
+        return None
+    return checkpoint
+
+
+def run_export(location, resume=False):
+    """Export everything in this process, e.g. from the datastore stub."""
+    checkpoint = _start(location, EXPORT_CHECKPOINT, resume)
+    while checkpoint:
+        checkpoint = export_batch(location, **checkpoint)
+        # Batches are independent, so keep the context cache from growing
+        ndb.get_context().clear_cache()
+
+
+def run_import(location, resume=False):
+    """Import a whole dump in this process, e.g. into the datastore stub.
+
+    Unlike the task chain, this leaves indexing the imported posts for
+    search to the caller.
+    """
+    checkpoint = _start(location, IMPORT_CHECKPOINT, resume)
+    while checkpoint:
+        checkpoint = import_batch(location, **checkpoint)
+        ndb.get_context().clear_cache()
+
+
+def _batch_task(url, job, location, checkpoint):
+    """Return the task running one batch, named so a retry never forks the chain."""
+    name = '%s-%s-%s-%d' % (url.rsplit('/', 1)[-1], job, checkpoint['kind'],
+                            checkpoint.get('part', 0))
+    params = dict(checkpoint, job=job, location=location)
+    if not params.get('cursor'):
+        params.pop('cursor', None)
+    return taskqueue.Task(url=url, name=name, params=params)
+
+
+def _queue_batch(url, job, location, checkpoint):
+    try:
+        taskqueue.Queue(QUEUE_NAME).add(_batch_task(url, job, location, checkpoint))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        # A retried batch already queued its successor
+        pass
+
+
+class _StartJob(webapp2.RequestHandler):
+    checkpoint_name = None
+    task_url = None
+
+    def get(self):
+        self.post()
+
+    def post(self):
+        location = self.request.get('location')
+        if not location:
+            self.error(400)
+            self.response.write('Pass ?location=gs://bucket/path')
+            return
+        checkpoint = _start(location, self.checkpoint_name, bool(self.request.get('resume')))
+        if checkpoint is None:
+            self.response.write('Already finished; leave out resume to start over')
+            return
+        job = str(int(time.time()))
+        _queue_batch(self.task_url, job, location, checkpoint)
+        self.response.write('Started job %s at %s' % (job, json.dumps(checkpoint)))
+
+
+class Export(_StartJob):
+    """Admin: export everything to ?location=, or resume with ?resume=1."""
+    checkpoint_name = EXPORT_CHECKPOINT
+    task_url = '/tasks/export_batch'
+
+
+class Import(_StartJob):
+    """Admin: import the dump at ?location=, or resume with ?resume=1."""
+    checkpoint_name = IMPORT_CHECKPOINT
+    task_url = '/tasks/import_batch'
+
+
+class ExportBatch(webapp2.RequestHandler):
+    """Task: export one batch and queue the next."""
+    def post(self):
+        location = self.request.get('location')
+        checkpoint = export_batch(location, self.request.get('kind'),
+                                  self.request.get('cursor') or None,
+                                  int(self.request.get('part', 0)))
+        if checkpoint:
+            _queue_batch('/tasks/export_batch', self.request.get('job'), location, checkpoint)
+
+
+class ImportBatch(webapp2.RequestHandler):
+    """Task: import one batch and queue the next; search is rebuilt at the end."""
+    def post(self):
+        location = self.request.get('location')
+        checkpoint = import_batch(location, self.request.get('kind'),
+                                  int(self.request.get('part', 0)))
+        if checkpoint:
+            _queue_batch('/tasks/import_batch', self.request.get('job'), location, checkpoint)
+        else:
+            taskqueue.add(url='/admin/reindex_search')
@@ -0,0 +1,58 @@
+# bulk_data.py
+#
+# Export or import medReach data (see bulk.py) in this process, against the
+# datastore stub rather than a deployed app.  Point --datastore at the
+# dev_appserver's datastore file to back it up or reseed it, or build a
+# dump to benchmark with (benchmark.py --dataset):
+#
+#   python bulk_data.py export dump/ --datastore ~/medreach.datastore --sdk ~/google_appengine
+#   python bulk_data.py import dump/ --datastore /tmp/seeded.datastore --resume
+#
+# On App Engine the same batches run as tasks from /admin/export and
+# /admin/import.
+
+import argparse
+import os
+
+from benchmark import setup_sdk
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export or import medReach data as NDJSON.')
+    parser.add_argument('action', choices=['export', 'import'])
+    parser.add_argument('location', help='dump directory')
+    parser.add_argument('--datastore', required=True,
+                        help='datastore file to read or write, as used by dev_appserver')
+    parser.add_argument('--app-id', help='application id the datastore file belongs to')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from the checkpoint of an interrupted run')
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='path to the App Engine Python SDK')
+    options = parser.parse_args()
+
+    setup_sdk(options.sdk)
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    if options.app_id:
+        bed.setup_env(app_id=options.app_id, overwrite=True)
+    bed.init_datastore_v3_stub(datastore_file=options.datastore, use_sqlite=True)
+    bed.init_memcache_stub()
+    bed.init_blobstore_stub()
+    bed.init_taskqueue_stub(root_path=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        # guestbook defines the models bulk reads and writes
+        import guestbook
+        import bulk
+        if options.action == 'export':
+            bulk.run_export(options.location, options.resume)
+        else:
+            bulk.run_import(options.location, options.resume)
+    finally:
+        bed.deactivate()
+    print '%sed %s' % (options.action.capitalize(), options.location)
+
+
+if __name__ == '__main__':
+    main()
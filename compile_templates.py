@@ -0,0 +1,48 @@
+# compile_templates.py
+#
+# Build step: precompile the Jinja templates the handlers render into Python
+# modules under compiled_templates/.  Deployed instances load those through
+# a ModuleLoader (see guestbook.template_loader) instead of parsing every
+# template on their first requests; a template whose source no longer
+# matches the hash recorded here is loaded from its source instead.  Run it
+# before each deploy with the same Python 2.7 and Jinja2 version as the
+# runtime (app.yaml libraries):
+#
+#   python compile_templates.py --sdk ~/google_appengine
+
+import argparse
+import json
+import os
+import shutil
+
+from benchmark import setup_sdk
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompile the medReach templates.')
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='path to the App Engine Python SDK')
+    options = parser.parse_args()
+
+    setup_sdk(options.sdk)
+    import jinja2
+    import guestbook
+
+    # Compile from the sources with the app's own environment settings
+    environment = guestbook.JINJA_ENVIRONMENT.overlay(
+        loader=jinja2.FileSystemLoader(guestbook.TEMPLATE_DIR))
+    if os.path.isdir(guestbook.COMPILED_TEMPLATE_DIR):
+        shutil.rmtree(guestbook.COMPILED_TEMPLATE_DIR)
+    environment.compile_templates(
+        guestbook.COMPILED_TEMPLATE_DIR, zip=None, ignore_errors=False,
+        filter_func=lambda name: name in guestbook.TEMPLATES,
+        log_function=lambda message: None)
+    with open(os.path.join(guestbook.COMPILED_TEMPLATE_DIR, guestbook.COMPILED_SOURCES_FILE), 'w') as f:
+        json.dump(dict((name, guestbook.template_digest(name)) for name in guestbook.TEMPLATES),
+                  f, indent=2, sort_keys=True)
+    print 'Compiled %d templates into %s' % (len(guestbook.TEMPLATES),
+                                            guestbook.COMPILED_TEMPLATE_DIR)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+# counters.py
+#
+# Sharded counters for totals that many requests update at once (votes,
+# comment counts).  Each increment touches one randomly chosen shard inside
+# its own transaction, so concurrent writers rarely contend and no single
+# entity group takes every write.  Totals are summed from all shards and
+# cached in memcache until the next increment.
+# https://cloud.google.com/appengine/articles/sharding_counters
+
+import random
+
+from google.appengine.ext import ndb
+
+
+# Number of shards per counter; raise it for counters written more often
+NUM_SHARDS = 20
+
+# Shards of the counters named '<field>:...' for fields whose counters are
+# seldom written at once, as every shard is one more key to read
+FIELD_SHARDS = {
+    'upvotes': 1,
+    'downvotes': 1,
+}
+
+# How long a summed total is served from memcache before it is re-read
+COUNT_CACHE_TIME = 5 * 60
+
+# Held in a counter's cache entry while a reader sums its shards; an
+# increment meanwhile drops the entry, so the reader's compare-and-set of a
+# total that may miss it fails
+_READING = 'reading'
+READING_TIME = 30
+
+
+class CounterShard(ndb.Model):
+    """One shard of a named counter, keyed by '<name>-<shard index>'"""
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+def num_shards(name):
+    """Return the number of shards of a named counter."""
+    return FIELD_SHARDS.get(name.split(':', 1)[0], NUM_SHARDS)
+
+
+def _shard_keys(name):
+    return [ndb.Key(CounterShard, '%s-%d' % (name, index))
+            for index in range(num_shards(name))]
+
+
+def _cache_key(name):
+    return 'counter:' + name
+
+
+def get_count(name):
+    """Return the total of a named counter."""
+    return get_counts([name])[name]
+
+
+def get_counts(names):
+    """Return a dict of name -> total for several counters at once."""
+    return get_counts_async(names).get_result()
+
+
+@ndb.tasklet
+def get_counts_async(names):
+    """Return a dict of name -> total for several counters at once.
+
+    Totals come from memcache where possible; the remaining counters have all
+    of their shards read in a single batch get.  A total is only cached if
+    no increment touched its entry while the shards were read.
+    """
+    context = ndb.get_context()
+    names = list(set(names))
+    cached = yield [context.memcache_get(_cache_key(name)) for name in names]
+    totals = {}
+    missing = []
+    for name, total in zip(names, cached):
+        if isinstance(total, (int, long)):
+            totals[name] = total
+        else:
+            missing.append(name)
+
+    if missing:
+        yield [context.memcache_add(_cache_key(name), _READING, time=READING_TIME)
+               for name in missing]
+        markers = yield [context.memcache_gets(_cache_key(name)) for name in missing]
+        shards = yield ndb.get_multi_async(
+            [key for name in missing for key in _shard_keys(name)])
+        totals.update(_sum_shards(missing, shards))
+        fresh = []
+        for name, marker in zip(missing, markers):
+            if marker == _READING:
+                fresh.append(context.memcache_cas(_cache_key(name), totals[name],
+                                                  time=COUNT_CACHE_TIME))
+        yield fresh
+
+    raise ndb.Return(totals)
+
+
+@ndb.tasklet
+def read_counts_async(names):
+    """Return a dict of name -> total summed straight from the shards.
+
+    Skips memcache and ndb's caches both ways, for readers that must not
+    act on a stale total; nothing read is cached.
+    """
+    names = list(set(names))
+    shards = yield ndb.get_multi_async(
+        [key for name in names for key in _shard_keys(name)],
+        use_cache=False, use_memcache=False)
+    raise ndb.Return(_sum_shards(names, shards))
+
+
+def _sum_shards(names, shards):
+    """Total the shards of names, read in the order of _shard_keys()."""
+    totals = {}
+    start = 0
+    for name in names:
+        end = start + num_shards(name)
+        totals[name] = sum(shard.count for shard in shards[start:end] if shard)
+        start = end
+    return totals
+
+
+@ndb.transactional_tasklet
+def _increment_shard_async(name, delta):
+    key = random.choice(_shard_keys(name))
+    shard = yield key.get_async()
+    if shard is None:
+        shard = CounterShard(key=key)
+    shard.count += delta
+    yield shard.put_async()
+
+
+def increment(name, delta=1):
+    """Add delta (which may be negative) to a named counter."""
+    increment_async(name, delta).get_result()
+
+
+@ndb.tasklet
+def increment_async(name, delta=1):
+    """Add delta (which may be negative) to a named counter."""
+    yield _increment_shard_async(name, delta)
+    # Drop the cached total, or the marker of a read in progress, so the
+    # next read sums the shards again
+    yield ndb.get_context().memcache_delete(_cache_key(name))
+
+
+@ndb.tasklet
+def delete_async(names):
+    """Delete named counters outright, along with their cached totals."""
+    context = ndb.get_context()
+    shards = yield ndb.get_multi_async(
+        [key for name in names for key in _shard_keys(name)])
+    yield (ndb.delete_multi_async([shard.key for shard in shards if shard]) +
+           [context.memcache_delete(_cache_key(name)) for name in names])
+
+
+@ndb.transactional_tasklet(xg=True)
+def _fold_shard_async(key, name):
+    first_key = _shard_keys(name)[0]
+    shard, first = yield key.get_async(), first_key.get_async()
+    if shard:
+        first = first or CounterShard(key=first_key)
+        first.count += shard.count
+        yield first.put_async(), key.delete_async()
+
+
+@ndb.tasklet
+def fold_extra_shards_async(keys):
+    """Fold shards beyond their counter's num_shards() into its first shard.
+
+    For counters whose shard count was lowered; returns how many shards of
+    keys were folded.
+    """
+    extra = []
+    for key in keys:
+        name, index = key.id().rsplit('-', 1)
+        if int(index) >= num_shards(name):
+            extra.append((key, name))
+    yield [_fold_shard_async(key, name) for key, name in extra]
+    context = ndb.get_context()
+    yield [context.memcache_delete(_cache_key(name)) for name in set(name for _, name in extra)]
+    raise ndb.Return(len(extra))
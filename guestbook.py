@@ -1,17 +1,30 @@
+import base64
+import datetime
 import os
 import urllib
 import json
+import collections
+import hashlib
+import logging
+import time
 
-from google.appengine.api import images
+from google.appengine.api import taskqueue
 from google.appengine.api import users
 from google.appengine.ext import ndb
 
 import jinja2
 import webapp2
 
+import assets
+import counters
+import imaging
+import instrumentation
+import notifications
+import ratelimit
+import search_index
+
 from google.appengine.ext import blobstore
 from google.appengine.ext.webapp import blobstore_handlers
-from google.appengine.ext.webapp.util import run_wsgi_app
 
 ## Import smtplib for the actual sending function
 #import smtplib
@@ -24,16 +37,171 @@ from google.appengine.ext.webapp.util import run_wsgi_app
 # Link to example of a general user-auth solution:
 # https://blog.abahgat.com/2013/01/07/user-authentication-with-webapp2-on-google-app-engine/
 
-from google.appengine.api import mail
+
+TEMPLATE_DIR = os.path.dirname(__file__)
+
+# Output of compile_templates.py, loaded instead of parsing the templates
+COMPILED_TEMPLATE_DIR = os.path.join(TEMPLATE_DIR, 'compiled_templates')
+
+# Written there by compile_templates.py: the SHA-1 of each template source
+# as it was compiled
+COMPILED_SOURCES_FILE = 'sources.json'
+
+# Every template the handlers render, as precompiled and warmed up
+TEMPLATES = ['index.html', 'discussion.html', 'settings.html', 'about.html', 'search.html', 'me.html',
+             'discussion_list.html', 'comment_thread.html']
+
+DEVELOPMENT = os.environ.get('SERVER_SOFTWARE', '').startswith('Development')
+
+
+def template_digest(name):
+    """Return the SHA-1 of a template's source."""
+    with open(os.path.join(TEMPLATE_DIR, name), 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class CompiledTemplateLoader(jinja2.BaseLoader):
+    """Loads the precompiled modules of the fresh templates, else the sources.
+
+    Jinja2 2.6's ChoiceLoader only asks its loaders for sources, which a
+    ModuleLoader has none of, so this picks the loader itself.
+    """
+
+    def __init__(self, path, fresh, sources):
+        self.compiled = jinja2.ModuleLoader(path)
+        self.fresh = fresh
+        self.sources = sources
+
+    def get_source(self, environment, template):
+        return self.sources.get_source(environment, template)
+
+    def list_templates(self):
+        return self.sources.list_templates()
+
+    def load(self, environment, name, globals=None):
+        if name in self.fresh:
+            return self.compiled.load(environment, name, globals)
+        return self.sources.load(environment, name, globals)
+
+
+def template_loader():
+    """Load precompiled templates when deployed, else the template sources.
+
+    A template edited without rerunning compile_templates.py is loaded from
+    its source, and logged, rather than served as it was compiled.
+    """
+    sources = jinja2.FileSystemLoader(TEMPLATE_DIR)
+    if DEVELOPMENT or not os.path.isdir(COMPILED_TEMPLATE_DIR):
+        return sources
+    try:
+        with open(os.path.join(COMPILED_TEMPLATE_DIR, COMPILED_SOURCES_FILE)) as f:
+            compiled = json.load(f)
+    except (IOError, ValueError):
+        compiled = {}
+    fresh = set(name for name in TEMPLATES if compiled.get(name) == template_digest(name))
+    if len(fresh) < len(TEMPLATES):
+        logging.error('Templates changed since compile_templates.py ran, loading their sources: %s',
+                      ', '.join(sorted(set(TEMPLATES) - fresh)))
+    return CompiledTemplateLoader(COMPILED_TEMPLATE_DIR, fresh, sources)
 
 
 JINJA_ENVIRONMENT = jinja2.Environment(
-    loader=jinja2.FileSystemLoader(os.path.dirname(__file__)),
+    loader=template_loader(),
     extensions=['jinja2.ext.autoescape'],
-    autoescape=True)
+    autoescape=True,
+    # Deployed templates never change, so skip checking them on every render
+    auto_reload=DEVELOPMENT)
+# Template renders are timed for requests sampled by instrumentation
+JINJA_ENVIRONMENT.template_class = instrumentation.TimedTemplate
+# Pages link the fingerprinted CSS/JS bundles of build_assets.py
+JINJA_ENVIRONMENT.globals['asset_urls'] = assets.asset_urls
 
 DEFAULT_DISCUSSION_NAME = 'default_discussion'
 
+# Number of comments (top-level and replies) shown per page of a discussion
+COMMENTS_PER_PAGE = 100
+
+# Number of discussions listed per front page, by default and at most
+DISCUSSIONS_PER_PAGE = 20
+MAX_DISCUSSIONS_PER_PAGE = 100
+
+# Categories a discussion can be filed under, as offered by the front page
+MEDICAL_CATEGORIES = ['general', 'pediatrics', 'obstetrics', 'cardiology', 'neurology',
+                      'dentistry', 'opthamology', 'orthopedics']
+
+# Front page orders: newest discussions first, most recently replied to, or
+# by hot score
+FRONT_PAGE_SORTS = ['new', 'active', 'hot']
+
+# A discussion's hot score gets points for being posted and for each comment
+# and vote, and halves every HOT_HALF_LIFE seconds.  Writes add to it and a
+# cron job decays every score; those below HOT_MIN drop to 0.  Votes are
+# counted apart and folded in by a task at most every HOT_FOLD_WINDOW seconds.
+HOT_DISCUSSION_POINTS = 1.0
+HOT_COMMENT_POINTS = 1.0
+HOT_VOTE_POINTS = 0.5
+HOT_HALF_LIFE = 12 * 60 * 60
+HOT_MIN = 0.01
+HOT_DECAY_BATCH_SIZE = 100
+HOT_FOLD_WINDOW = 60
+
+# Lists of the /me page: the user's own discussions, or their comments
+ACTIVITY_VIEWS = ['discussions', 'replies']
+
+# Characters of a discussion's text and number of its latest photos that
+# its front page summary keeps
+SUMMARY_EXCERPT_LENGTH = 200
+SUMMARY_PHOTOS = 6
+
+# Number of legacy MrUser rows merged per migration task
+MIGRATION_BATCH_SIZE = 100
+
+# Browser/edge cache lifetime for image URLs whose bytes can never change
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Cache lifetime for unversioned image URLs whose bytes may change
+MUTABLE_MAX_AGE = 60 * 60
+
+# With INLINE_AVATARS set in app.yaml, comment threads embed avatars of at
+# most INLINE_AVATAR_MAX_BYTES as data: URIs instead of linking /img
+INLINE_AVATARS = os.environ.get('INLINE_AVATARS', '0') == '1'
+INLINE_AVATAR_MAX_BYTES = 2048
+
+# Memcache lifetime of rendered page fragments; writes invalidate them sooner
+FRAGMENT_CACHE_TIME = 60 * 60
+
+# Cache scope of the front page discussion list
+FRONT_PAGE_SCOPE = 'front'
+
+# The front page is listed by a global query that can lag a write by a few
+# seconds, so a list rendered just after a bump may be stale; its fragments
+# are only kept this long
+FRONT_PAGE_CACHE_TIME = 15
+
+# How long a browser session may hold on to unused photo upload URLs; kept
+# inside the blobstore's own expiry of the URLs
+UPLOAD_URL_LIFETIME = 5 * 60
+
+# Most upload URLs handed out by one /upload_urls request, which is charged
+# a rate limit token for each.  Each is a blobstore RPC and few readers
+# attach more than a photo or two per visit, so pages fetch a small batch
+# only once they have run out
+MAX_UPLOAD_URLS = ratelimit.ITEM_COSTS['/upload_urls'][1]
+
+# Entities carrying embedded photos are large, so migrate them in small batches
+PHOTO_MIGRATION_BATCH_SIZE = 20
+
+# Changes this many seconds older than a client's version are sent again, in
+# case they were written by another instance after its last poll started
+CHANGE_OVERLAP = 10
+
+# Thread changes are kept this long by the /tasks/prune_changes cron job;
+# clients whose version is older are told to reload instead
+CHANGE_RETENTION = 60 * 60
+
+# Keys removed per batch of a cascading delete; larger trees go on in tasks
+DELETE_BATCH_SIZE = 100
+
 # Setup several ndb entities
 # Todo:  Make Owner and Author children of same parent
 # https://cloud.google.com/appengine/docs/python/users/userobjects 
@@ -42,7 +210,8 @@ DEFAULT_DISCUSSION_NAME = 'default_discussion'
 
 class Author(ndb.Model):
     """Sub model for representing a comment author"""
-    identity = ndb.StringProperty(indexed=False)
+    # Indexed for the /me list of a user's comments
+    identity = ndb.StringProperty()
     email = ndb.StringProperty(indexed=False)
 
 class Owner(ndb.Model):
@@ -55,11 +224,14 @@ class Greeting(ndb.Model):
     author = ndb.StructuredProperty(Author)
     content = ndb.StringProperty(indexed=False)
     upvotes = ndb.IntegerProperty()
-    upvote_ids = ndb.IntegerProperty(repeated=True) 
+    # Legacy voter MrUser ids, no longer written; votes are CommentVote entities
+    upvote_ids = ndb.GenericProperty(repeated=True)
     downvotes = ndb.IntegerProperty()
-    downvote_ids = ndb.IntegerProperty(repeated=True)
+    downvote_ids = ndb.GenericProperty(repeated=True)
     date = ndb.DateTimeProperty(auto_now_add=True)
     num_comments = ndb.IntegerProperty()
+    photo_keys = ndb.KeyProperty(kind='Photo', repeated=True)
+    # Legacy embedded images, moved into Photo entities by /admin/migrate_photos
     photos = ndb.BlobProperty(repeated=True)
     subcomment = ndb.BooleanProperty()
     
@@ -75,14 +247,68 @@ class Discussion(ndb.Model):
     date = ndb.DateTimeProperty(auto_now_add=True)
     medical_category = ndb.StringProperty()
     num_comments = ndb.IntegerProperty()
+    photo_keys = ndb.KeyProperty(kind='Photo', repeated=True)
+    # Legacy embedded images, moved into Photo entities by /admin/migrate_photos
     photos = ndb.BlobProperty(repeated=True)
     
+class DiscussionSummary(ndb.Model):
+    """The compact copy of a Discussion listed on the front page
+
+    Stored under its discussion, see summary_key(), so the writes that
+    change a discussion or its comments update it in the same transaction.
+    """
+    title = ndb.StringProperty(indexed=False)
+    # The owner's Google user id, for the /me list of their discussions
+    owner_id = ndb.StringProperty()
+    owner_email = ndb.StringProperty(indexed=False)
+    excerpt = ndb.StringProperty(indexed=False)
+    medical_category = ndb.StringProperty()
+    date = ndb.DateTimeProperty()
+    last_activity = ndb.DateTimeProperty()
+    last_author_email = ndb.StringProperty(indexed=False)
+    num_comments = ndb.IntegerProperty(default=0, indexed=False)
+    # The latest few of the discussion's photo_keys
+    photo_keys = ndb.KeyProperty(kind='Photo', repeated=True, indexed=False)
+    # Hot score as of hot_date, see heat()
+    hot = ndb.FloatProperty(default=0.0)
+    hot_date = ndb.DateTimeProperty(indexed=False)
+    # The discussion's hot_votes counter as last folded into hot
+    hot_votes = ndb.IntegerProperty(default=0, indexed=False)
+
+    @property
+    def discussion_key(self):
+        return self.key.parent()
+
+class Photo(ndb.Model):
+    """A single uploaded image, stored as a child of the greeting showing it
+
+    New photos keep their original in the blobstore and get PhotoRendition
+    children from imaging tasks; older photos hold one resized copy in data.
+    """
+    original = ndb.BlobKeyProperty()
+    data = ndb.BlobProperty()
+    content_type = ndb.StringProperty(indexed=False)
+    digest = ndb.StringProperty(indexed=False)
+    date = ndb.DateTimeProperty(auto_now_add=True)
+
+class PhotoRendition(ndb.Model):
+    """One resized copy of a Photo, keyed by rendition name under the Photo"""
+    data = ndb.BlobProperty()
+    digest = ndb.StringProperty(indexed=False)
+
 class MrUser(ndb.Model):
-    """A main model for local persistence of the logged-in user"""
+    """A main model for local persistence of the logged-in user
+
+    Keyed by the Google user id, see mr_user_key().  The vote id lists hold
+    votes cast before CommentVote existed and are no longer written.
+    """
     userid = ndb.StringProperty()
     # this is the key of the current discussion
     currentDiscussionKey = ndb.StringProperty()
+    # 32x32 and 64x64 renditions of the uploaded avatar_original
     avatar = ndb.BlobProperty()
+    avatar_64 = ndb.BlobProperty()
+    avatar_original = ndb.BlobKeyProperty()
     upvotes = ndb.IntegerProperty()
     upvote_ids = ndb.IntegerProperty(repeated=True)
     downvotes = ndb.IntegerProperty()
@@ -90,30 +316,783 @@ class MrUser(ndb.Model):
     num_comments = ndb.IntegerProperty()
 
 
+class CommentVote(ndb.Model):
+    """One user's vote on a comment, keyed by the comment under the voter's MrUser"""
+    discussion = ndb.KeyProperty(kind='Discussion')
+    # The comment voted on, for deleting its votes with it
+    comment = ndb.KeyProperty(kind='Greeting')
+    vote_type = ndb.StringProperty(indexed=False)
+    date = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class ThreadChange(ndb.Model):
+    """A change to a discussion or one of its comments
+
+    Feeds the JSON changes of /api/thread; the post is the discussion or
+    comment whose current state the change sends.  Kept out of the
+    discussion's entity group so logging one never contends with its writes.
+    """
+    discussion = ndb.KeyProperty(kind='Discussion')
+    post = ndb.KeyProperty(indexed=False)
+    deleted = ndb.BooleanProperty(indexed=False)
+    date = ndb.DateTimeProperty(auto_now_add=True)
+
+
+def mr_user_key(user_id):
+    """Return the key of the MrUser belonging to a Google user id."""
+    return ndb.Key(MrUser, user_id)
+
+
+def get_mr_user(user_id, create=False):
+    """Resolve the MrUser for a Google user id, see get_mr_user_async()."""
+    return get_mr_user_async(user_id, create).get_result()
+
+
+@ndb.tasklet
+def get_mr_user_async(user_id, create=False):
+    """Resolve the MrUser for a Google user id.
+
+    Lookups are strongly consistent key gets served from the ndb context
+    cache and memcache, and are memoized for the rest of the current request.
+    If create is set, a missing MrUser is inserted.
+    """
+    if not user_id:
+        raise ndb.Return(None)
+    memo = webapp2.get_request().registry.setdefault('mr_users', {})
+    mr_user = memo.get(user_id)
+    if mr_user is None:
+        mr_user = yield mr_user_key(user_id).get_async()
+        if mr_user is None and create:
+            mr_user = yield MrUser.get_or_insert_async(user_id, userid=user_id)
+        memo[user_id] = mr_user
+    raise ndb.Return(mr_user)
+
+
+def comment_vote_key(user_id, greeting_key):
+    """Return the key of a user's vote on a comment."""
+    return ndb.Key(CommentVote, greeting_key.urlsafe(), parent=mr_user_key(user_id))
+
+
+@ndb.transactional_tasklet
+def record_vote_async(user_id, greeting_key, discussion_key, vote_type):
+    """Store a user's vote on a comment; return False if they already voted."""
+    key = comment_vote_key(user_id, greeting_key)
+    existing = yield key.get_async()
+    if existing:
+        raise ndb.Return(False)
+    yield CommentVote(key=key, discussion=discussion_key, comment=greeting_key,
+                      vote_type=vote_type).put_async()
+    raise ndb.Return(True)
+
+
+@ndb.tasklet
+def discussion_votes_async(user_id, discussion_key):
+    """Return {greeting urlsafe key: vote type} of a user's votes in a discussion."""
+    query = CommentVote.query(ancestor=mr_user_key(user_id)).filter(
+        CommentVote.discussion == discussion_key)
+    votes = yield query.fetch_async()
+    raise ndb.Return(dict((vote.key.id(), vote.vote_type) for vote in votes))
+
+
+def merge_mr_users(target, legacy):
+    """Fold a legacy query-keyed MrUser row into its keyed replacement."""
+    if not target.avatar:
+        target.avatar = legacy.avatar
+    if not target.currentDiscussionKey:
+        target.currentDiscussionKey = legacy.currentDiscussionKey
+    totals = counter_totals([legacy], 'upvotes', 'downvotes', 'num_comments')[legacy.key]
+    target.upvotes = (target.upvotes or 0) + totals['upvotes']
+    target.downvotes = (target.downvotes or 0) + totals['downvotes']
+    target.num_comments = (target.num_comments or 0) + totals['num_comments']
+    for greeting_id in legacy.upvote_ids:
+        if greeting_id not in target.upvote_ids:
+            target.upvote_ids.append(greeting_id)
+    for greeting_id in legacy.downvote_ids:
+        if greeting_id not in target.downvote_ids:
+            target.downvote_ids.append(greeting_id)
+
+
+def counter_name(field, key):
+    """Return the name of the sharded counter behind an entity's counted field."""
+    return '%s:%s' % (field, key.urlsafe())
+
+
+def count_async(field, key, delta=1):
+    """Add delta to an entity's counted field (upvotes, downvotes, num_comments)."""
+    return counters.increment_async(counter_name(field, key), delta)
+
+
+def counter_totals(entities, *fields):
+    """Return {key: {field: total}}, see counter_totals_async()."""
+    return counter_totals_async(entities, *fields).get_result()
+
+
+@ndb.tasklet
+def counter_totals_async(entities, *fields):
+    """Return {key: {field: total}} of counted fields for several entities.
+
+    The stored property holds the total from before the field was sharded,
+    and the sharded counter holds everything since.
+    """
+    names = [counter_name(field, entity.key) for entity in entities for field in fields]
+    counts = yield counters.get_counts_async(names)
+    totals = {}
+    for entity in entities:
+        totals[entity.key] = dict(
+            (field, (getattr(entity, field) or 0) + counts[counter_name(field, entity.key)])
+            for field in fields)
+    raise ndb.Return(totals)
+
+
+def image_digest(data):
+    """Return the content hash used as the ETag and URL version of an image."""
+    return hashlib.sha1(data).hexdigest()
+
+
+def image_content_type(data):
+    """Sniff the MIME type of image bytes from their magic number."""
+    if data.startswith('\x89PNG'):
+        return 'image/png'
+    if data.startswith('\xff\xd8'):
+        return 'image/jpeg'
+    if data.startswith('GIF8'):
+        return 'image/gif'
+    if data.startswith('RIFF') and data[8:12] == 'WEBP':
+        return 'image/webp'
+    if data.startswith('BM'):
+        return 'image/bmp'
+    return 'application/octet-stream'
+
+
+def new_photo(parent, data):
+    """Build a Photo for image bytes with its content type and digest filled in."""
+    return Photo(parent=parent, data=data,
+                 content_type=image_content_type(data), digest=image_digest(data))
+
+
+def write_cached_image(handler, data, digest, cache_control):
+    """Write image bytes with caching headers, or a bare 304 if the client is current."""
+    handler.response.headers['ETag'] = '"%s"' % digest
+    handler.response.headers['Cache-Control'] = cache_control
+    if digest in handler.request.if_none_match:
+        handler.response.status = 304
+        return
+    handler.response.headers['Content-Type'] = image_content_type(data)
+    handler.response.out.write(data)
+
+
+def avatar_src(user_id, mr_user, inline=False):
+    """Return the img src of a user's 32x32 avatar, or None if they have none.
+
+    The /img URL is addressed by user and versioned by the avatar's digest,
+    so a browser fetches each avatar once however many comments show it.
+    With inline, a small avatar is embedded as a data: URI instead.
+    """
+    if not mr_user or not mr_user.avatar:
+        return None
+    if inline and len(mr_user.avatar) <= INLINE_AVATAR_MAX_BYTES:
+        return 'data:%s;base64,%s' % (image_content_type(mr_user.avatar),
+                                      base64.b64encode(mr_user.avatar))
+    return '/img?' + urllib.urlencode([('user_id', user_id), ('v', image_digest(mr_user.avatar))])
+
+
+def photo_urls(entity, size):
+    """Return the /photo URLs of a rendition of every image attached to an entity."""
+    urls = ['/photo?photo_key=%s&size=%s' % (photo_key.urlsafe(), size)
+            for photo_key in entity.photo_keys]
+    # Rows not yet migrated still serve their embedded photos by index
+    for index in range(1, len(getattr(entity, 'photos', [])) + 1):
+        urls.append('/photo?img_id=%s&loop_index=%d' % (entity.key.urlsafe(), index))
+    return urls
+
+JINJA_ENVIRONMENT.globals['photo_urls'] = photo_urls
+
+
+def move_embedded_photos(entity):
+    """Move an entity's embedded photos into child Photo entities."""
+    photos = [new_photo(entity.key, data) for data in entity.photos if data]
+    entity.photo_keys.extend(ndb.put_multi(photos))
+    entity.photos = []
+
+
+def summary_key(discussion_key):
+    """Return the key of a discussion's front page summary."""
+    return ndb.Key(DiscussionSummary, 'summary', parent=discussion_key)
+
+
+def summarize(discussion, summary=None):
+    """Copy a discussion's listed fields onto its summary, new or existing."""
+    if summary is None:
+        summary = DiscussionSummary(key=summary_key(discussion.key),
+                                    date=discussion.date,
+                                    last_activity=discussion.date,
+                                    hot=HOT_DISCUSSION_POINTS,
+                                    hot_date=discussion.date)
+    summary.title = discussion.title
+    summary.owner_id = discussion.owner.identity if discussion.owner else None
+    summary.owner_email = discussion.owner.email if discussion.owner else None
+    summary.excerpt = (discussion.content or '')[:SUMMARY_EXCERPT_LENGTH]
+    summary.medical_category = discussion.medical_category
+    summary.photo_keys = discussion.photo_keys[-SUMMARY_PHOTOS:]
+    return summary
+
+
+def heat(summary, points, now=None):
+    """Decay a summary's hot score to now and add points for new activity."""
+    now = now or datetime.datetime.utcnow()
+    hot = summary.hot or 0.0
+    if hot and summary.hot_date:
+        age = max(0.0, (now - summary.hot_date).total_seconds())
+        hot *= 0.5 ** (age / HOT_HALF_LIFE)
+    summary.hot = hot + points
+    summary.hot_date = now
+
+
+@ndb.tasklet
+def heat_vote_async(discussion_key):
+    """Count a vote towards a discussion's hot score.
+
+    The vote goes to a sharded counter rather than the summary, which shares
+    the discussion's entity group; a /tasks/fold_votes task scheduled for
+    the current window folds it in.
+    """
+    yield count_async('hot_votes', discussion_key)
+    yield schedule_fold_votes_async(discussion_key)
+
+
+@ndb.tasklet
+def schedule_fold_votes_async(discussion_key, after=None):
+    """Schedule folding a discussion's votes into its hot score.
+
+    One task per discussion per HOT_FOLD_WINDOW, named for its window; a
+    fold task passes its own window as after, so the one scheduled is
+    always a later one.
+    """
+    now = time.time()
+    window = int(now) // HOT_FOLD_WINDOW
+    if after is not None:
+        window = max(window, after + 1)
+    discussion_hash = hashlib.sha1(discussion_key.urlsafe()).hexdigest()
+    # If this window's fold already ran, the vote is folded in the next one
+    for offset in (0, 1):
+        task = taskqueue.Task(
+            url='/tasks/fold_votes',
+            name='fold-%s-%d' % (discussion_hash, window + offset),
+            params={'discussion_key': discussion_key.urlsafe(), 'window': window + offset},
+            countdown=(window + offset + 1) * HOT_FOLD_WINDOW - now)
+        try:
+            yield taskqueue.Queue().add_async(task)
+        except taskqueue.TaskAlreadyExistsError:
+            pass
+        except taskqueue.TombstonedTaskError:
+            continue
+        return
+
+
+@ndb.transactional_tasklet
+def fold_votes_async(discussion_key, votes):
+    """Add the votes counted since the last fold to a discussion's hot score.
+
+    votes is the counter's total read straight from its shards; a total no
+    higher than the one last folded has no new votes.  The counter only
+    restarts along with the summary's hot_votes, on import.
+    """
+    summary = yield summary_key(discussion_key).get_async()
+    if summary and votes > summary.hot_votes:
+        heat(summary, (votes - summary.hot_votes) * HOT_VOTE_POINTS)
+        summary.hot_votes = votes
+        yield summary.put_async()
+
+
+@ndb.transactional_tasklet
+def decay_heat_async(key, now):
+    """Decay one summary's hot score to now, dropping it to 0 once negligible."""
+    summary = yield key.get_async()
+    if summary and summary.hot:
+        heat(summary, 0, now)
+        if summary.hot < HOT_MIN:
+            summary.hot = 0.0
+        yield summary.put_async()
+
+
+def save_discussion(discussion):
+    """Store a new or edited discussion, see save_discussion_async()."""
+    return save_discussion_async(discussion).get_result()
+
+
+@ndb.transactional_tasklet
+def save_discussion_async(discussion):
+    """Store a new or edited discussion together with its summary."""
+    new = discussion.key is None
+    key = yield discussion.put_async()
+    summary = yield summary_key(key).get_async()
+    # Discussions from before summaries get theirs from /admin/build_summaries,
+    # which can also count their comments
+    if summary or new:
+        yield summarize(discussion, summary).put_async()
+    raise ndb.Return(key)
+
+
+@ndb.transactional_tasklet
+def add_comment_async(greeting, discussion_key):
+    """Store a new comment and record it on its discussion's summary."""
+    summary = yield summary_key(discussion_key).get_async()
+    yield greeting.put_async()
+    if summary:
+        summary.num_comments += 1
+        summary.last_activity = greeting.date
+        summary.last_author_email = greeting.author.email if greeting.author else None
+        heat(summary, HOT_COMMENT_POINTS, greeting.date)
+        yield summary.put_async()
+
+
+@ndb.transactional_tasklet
+def attach_photo_async(photo, greeting_key, discussion_key):
+    """Store a photo and list it on its greeting, discussion and summary.
+
+    Returns the photo's key, or None if the greeting or discussion is gone.
+    """
+    greeting, discussion, summary = yield (greeting_key.get_async(),
+                                           discussion_key.get_async(),
+                                           summary_key(discussion_key).get_async())
+    if greeting is None or discussion is None:
+        raise ndb.Return(None)
+    photo_key = yield photo.put_async()
+    greeting.photo_keys.append(photo_key)
+    discussion.photo_keys.append(photo_key)
+    entities = [greeting, discussion]
+    if summary:
+        entities.append(summarize(discussion, summary))
+    yield ndb.put_multi_async(entities)
+    raise ndb.Return(photo_key)
+
+
+def discussion_scope(discussion_key):
+    """Return the fragment cache scope of one discussion thread."""
+    return 'discussion:' + discussion_key.urlsafe()
+
+
+@ndb.tasklet
+def cache_version_async(scope):
+    """Return the current generation number of a fragment cache scope."""
+    context = ndb.get_context()
+    version = yield context.memcache_get('version:' + scope)
+    if version is None:
+        # Seed from the clock so an evicted counter never reuses old fragments
+        version = int(time.time())
+        added = yield context.memcache_add('version:' + scope, version)
+        if not added:
+            version = (yield context.memcache_get('version:' + scope)) or version
+    raise ndb.Return(version)
+
+
+def bump_cache_version(*scopes):
+    """Invalidate every cached fragment of the given scopes."""
+    ndb.Future.wait_all(bump_cache_version_async(*scopes))
+
+
+def bump_cache_version_async(*scopes):
+    """Invalidate every cached fragment of the given scopes; returns the futures."""
+    context = ndb.get_context()
+    return [context.memcache_incr('version:' + scope, initial_value=int(time.time()))
+            for scope in scopes]
+
+
+@ndb.tasklet
+def render_fragment_async(scope, name, template_name, values, cache_time=FRAGMENT_CACHE_TIME):
+    """Render a template fragment through memcache.
+
+    The cache key carries the scope's generation number, so bumping the scope
+    invalidates its fragments. values is a tasklet, only called on a cache
+    miss, so a cache hit does no datastore work.
+    """
+    context = ndb.get_context()
+    version = yield cache_version_async(scope)
+    key = 'fragment:%s:%s:%s' % (scope, version, name)
+    key = 'fragment:' + hashlib.sha1(key.encode('utf-8')).hexdigest()
+    html = yield context.memcache_get(key)
+    if html is None:
+        html = JINJA_ENVIRONMENT.get_template(template_name).render((yield values()))
+        yield context.memcache_set(key, html, time=cache_time)
+    raise ndb.Return(jinja2.Markup(html))
+
+
+def page_size_param(request, default, maximum, name='limit'):
+    """Read a page size from the request, clamped to 1..maximum."""
+    try:
+        size = int(request.get(name, default))
+    except ValueError:
+        size = default
+    return max(1, min(size, maximum))
+
+
+def cursor_param(request):
+    """Read the query cursor of the requested page, if any."""
+    if request.get('cursor'):
+        return ndb.Cursor(urlsafe=request.get('cursor'))
+    return None
+
+
+@ndb.tasklet
+def front_page_values_async(category, sort, page_size, cursor):
+    """Load one page of the discussion list shown on the front page.
+
+    This is one query over the small DiscussionSummary entities, newest or
+    most recently active first, filtered by category through the indexes
+    in index.yaml.
+    """
+    query = DiscussionSummary.query()
+    if category:
+        query = query.filter(DiscussionSummary.medical_category == category)
+    if sort == 'active':
+        query = query.order(-DiscussionSummary.last_activity)
+    elif sort == 'hot':
+        query = query.order(-DiscussionSummary.hot)
+    else:
+        query = query.order(-DiscussionSummary.date)
+    summaries, next_cursor, more = yield query.fetch_page_async(page_size, start_cursor=cursor)
+
+    # If there are no discussions, create the welcome discussion
+    if (not summaries and not category and not cursor and
+            not (yield Discussion.query().get_async(keys_only=True))):
+        discussion = Discussion(title='Welcome - What is medReach?', medical_category='general', num_comments=0)
+        key = yield save_discussion_async(discussion)
+        greeting = Greeting(parent=key)
+        greeting.author = Author(email='medReach')
+        greeting.content = 'Welcome to medReach'
+        yield add_comment_async(greeting, key)
+        summary = yield summary_key(key).get_async()
+        summaries = [summary]
+
+    raise ndb.Return({
+        'summaries': summaries,
+        'categories': MEDICAL_CATEGORIES,
+        'category': category,
+        'sorts': FRONT_PAGE_SORTS,
+        'sort': sort,
+        'page_size': page_size,
+        'next_cursor': next_cursor.urlsafe() if more and next_cursor else None,
+    })
+
+
+def activity_values(user_id, show, page_size, cursor):
+    """Load one page of a user's own discussions or comments, newest first.
+
+    Either list is one query on the indexed owner_id or author.identity
+    (see index.yaml), paged with a cursor; comments get their discussions'
+    titles from one batch get of the summaries.
+    """
+    values = {
+        'views': ACTIVITY_VIEWS,
+        'show': show,
+        'page_size': page_size,
+    }
+    if show == 'replies':
+        query = Greeting.query(Greeting.author.identity == user_id).order(-Greeting.date)
+        greetings, next_cursor, more = query.fetch_page(page_size, start_cursor=cursor)
+        discussion_keys = [ndb.Key(pairs=greeting.key.pairs()[:1]) for greeting in greetings]
+        summaries = ndb.get_multi([summary_key(key) for key in set(discussion_keys)])
+        titles = dict((summary.discussion_key, summary.title) for summary in summaries if summary)
+        values['replies'] = [(greeting, key, titles.get(key))
+                             for greeting, key in zip(greetings, discussion_keys)]
+    else:
+        query = DiscussionSummary.query(DiscussionSummary.owner_id == user_id).order(
+            -DiscussionSummary.date)
+        values['summaries'], next_cursor, more = query.fetch_page(page_size, start_cursor=cursor)
+    values['next_cursor'] = next_cursor.urlsafe() if more and next_cursor else None
+    return values
+
+
+@ndb.tasklet
+def comment_thread_values_async(discussion_key, limit, cursor):
+    """Load one page of a discussion's comments, their counts and authors' avatars."""
+    greeting_list, next_cursor, more = yield load_comment_tree_async(discussion_key, limit, cursor)
+
+    # Every distinct author is resolved in one batch; authors without an
+    # avatar get none and are shown the glyph
+    author_ids = list(set(greeting.author.identity
+                          for thread in greeting_list for greeting in thread
+                          if greeting.author and greeting.author.identity))
+    greetings = [greeting for thread in greeting_list for greeting in thread]
+    authors, counts = yield (
+        ndb.get_multi_async([mr_user_key(author_id) for author_id in author_ids]),
+        counter_totals_async(greetings, 'upvotes', 'downvotes'))
+    avatars = dict((author_id, avatar_src(author_id, author, INLINE_AVATARS))
+                   for author_id, author in zip(author_ids, authors))
+
+    raise ndb.Return({
+        'discussion_key': discussion_key,
+        'greeting_list': greeting_list,
+        'counts': counts,
+        'avatars': avatars,
+        'next_cursor': next_cursor.urlsafe() if more and next_cursor else None,
+    })
+
+
+def current_version():
+    """Return the thread version of now, in microseconds since the epoch."""
+    return int(time.time() * 1000000)
+
+
+def version_param(request, default=None):
+    """Read a thread version from the since parameter."""
+    try:
+        return int(request.get('since'))
+    except ValueError:
+        return default
+
+
+def record_change_async(discussion_key, post_key, deleted=False):
+    """Log a change to a discussion's thread; returns the future."""
+    return ThreadChange(discussion=discussion_key, post=post_key, deleted=deleted).put_async()
+
+
+def greeting_json(greeting, counts):
+    """Return the JSON-able form of a comment and its vote counts."""
+    return {
+        'key': greeting.key.urlsafe(),
+        'parent': greeting.key.parent().urlsafe(),
+        'subcomment': bool(greeting.subcomment),
+        'author': greeting.author.email if greeting.author else None,
+        'content': greeting.content,
+        'date': greeting.date.isoformat() if greeting.date else None,
+        'upvotes': counts['upvotes'],
+        'downvotes': counts['downvotes'],
+        'photos': photo_urls(greeting, 'display'),
+    }
+
+
+def discussion_json(discussion):
+    """Return the JSON-able form of a discussion's own fields."""
+    return {
+        'key': discussion.key.urlsafe(),
+        'title': discussion.title,
+        'content': discussion.content,
+        'medical_category': discussion.medical_category,
+        'owner': discussion.owner.email if discussion.owner else None,
+    }
+
+
+@ndb.tasklet
+def thread_changes_async(discussion_key, since):
+    """Return the changes to a discussion's thread since a version, as JSON-able.
+
+    Changed comments are sent whole with their current vote counts, so
+    sending one again does no harm; that lets each call overlap the previous
+    one by CHANGE_OVERLAP and catch changes that became visible late, as the
+    change log is queried by its (discussion, date) index.  Clients pass the
+    version returned as since on their next call; one older than
+    CHANGE_RETENTION gets expired instead, as its changes may be pruned.
+    """
+    version = current_version()
+    if since < version - CHANGE_RETENTION * 1000000:
+        raise ndb.Return({'version': version, 'greetings': [], 'deleted': [], 'expired': True})
+    start = datetime.datetime.utcfromtimestamp(since / 1000000.0 - CHANGE_OVERLAP)
+    query = ThreadChange.query(ThreadChange.discussion == discussion_key,
+                               ThreadChange.date > start)
+    discussion, changes = yield discussion_key.get_async(), query.fetch_async()
+    if discussion is None:
+        raise ndb.Return({'version': version, 'greetings': [],
+                          'deleted': [discussion_key.urlsafe()]})
+
+    deleted = set(change.post for change in changes if change.deleted)
+    keys = list(set(change.post for change in changes
+                    if change.post not in deleted and change.post != discussion_key))
+    greetings = yield ndb.get_multi_async(keys)
+    deleted.update(key for key, greeting in zip(keys, greetings) if greeting is None)
+    greetings = sorted((greeting for greeting in greetings if greeting),
+                       key=lambda greeting: greeting.date)
+    counts = yield counter_totals_async(greetings, 'upvotes', 'downvotes')
+
+    result = {
+        'version': version,
+        'greetings': [greeting_json(greeting, counts[greeting.key]) for greeting in greetings],
+        'deleted': [key.urlsafe() for key in deleted],
+    }
+    if any(change.post == discussion_key for change in changes):
+        result['discussion'] = discussion_json(discussion)
+    raise ndb.Return(result)
+
+
+def write_json(handler, value):
+    """Write a JSON response that no cache may keep."""
+    handler.response.headers['Content-Type'] = 'application/json'
+    handler.response.headers['Cache-Control'] = 'private, no-store'
+    handler.response.write(json.dumps(value))
+
+
+@ndb.tasklet
+def finish_thread_write_async(handler, discussion_key):
+    """End a write to a discussion's thread.
+
+    Forms are redirected back to the discussion page.  Scripts posting with
+    format=json instead get the thread's changes since their since version,
+    their own write included, and update the page in place.
+    """
+    if handler.request.get('format') != 'json':
+        handler.redirect('/discussion?discussion_key=' + discussion_key.urlsafe())
+        return
+    since = version_param(handler.request, current_version())
+    changes = yield thread_changes_async(discussion_key, since)
+    write_json(handler, changes)
+
+
+@ndb.tasklet
+def load_comment_tree_async(discussion_key, limit=COMMENTS_PER_PAGE, cursor=None):
+    """Build the jagged comment/sub-comment list for one page of a discussion.
+
+    A single ancestor query returns every descendant of the discussion, so
+    replies are grouped under their top-level comment in memory rather than
+    issuing a query per comment. Returns (greeting_list, next_cursor, more).
+    """
+    query = Greeting.query(ancestor=discussion_key).order(Greeting.date)
+    greetings, next_cursor, more = yield query.fetch_page_async(limit, start_cursor=cursor)
+
+    # The top-level comment is the path element directly below the discussion
+    depth = len(discussion_key.pairs()) + 1
+    threads = collections.OrderedDict()
+    for greeting in greetings:
+        root_key = ndb.Key(pairs=greeting.key.pairs()[:depth])
+        threads.setdefault(root_key, []).append(greeting)
+
+    # Replies whose top-level comment fell on an earlier page still need it
+    # at the head of their list, so fetch those roots in one batch
+    missing = [root_key for root_key, thread in threads.items()
+               if thread[0].key != root_key]
+    roots = yield ndb.get_multi_async(missing)
+    for root in roots:
+        if root:
+            threads[root.key].insert(0, root)
+
+    raise ndb.Return((threads.values(), next_cursor, more))
+
+
+@ndb.transactional_tasklet
+def forget_deleted_async(discussion_key, num_comments, photo_keys):
+    """Take deleted comments and photos off a discussion and its summary."""
+    discussion, summary = yield (discussion_key.get_async(),
+                                 summary_key(discussion_key).get_async())
+    if discussion:
+        discussion.photo_keys = [key for key in discussion.photo_keys
+                                 if key not in photo_keys]
+        entities = [discussion]
+        if summary:
+            summarize(discussion, summary)
+            summary.num_comments = max(0, summary.num_comments - num_comments)
+            entities.append(summary)
+        yield ndb.put_multi_async(entities)
+
+
+@ndb.tasklet
+def delete_tree_batch_async(root_key, discussion_key, cursor=None):
+    """Delete one batch of root_key and the entities beneath it.
+
+    Comments, their replies, photos, renditions and the summary all sit in the
+    discussion's entity group, so a kindless keys-only ancestor query finds
+    them. Votes, photo originals, counter shards and the discussion's comment
+    count are cleaned up alongside. Returns the cursor to continue from, or None
+    once the tree is gone.
+    """
+    query = ndb.Query(ancestor=root_key)
+    keys, next_cursor, more = yield query.fetch_page_async(
+        DELETE_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+    greeting_keys = [key for key in keys if key.kind() == 'Greeting']
+    photo_keys = [key for key in keys if key.kind() == 'Photo']
+    photos = yield ndb.get_multi_async(photo_keys)
+
+    counter_names = [counter_name(field, key) for key in greeting_keys
+                     for field in ('upvotes', 'downvotes')]
+    futures = ndb.delete_multi_async(keys)
+    if root_key == discussion_key:
+        # Votes are stored under their voters, so find them by discussion
+        vote_keys = yield CommentVote.query(
+            CommentVote.discussion == discussion_key).fetch_async(
+                DELETE_BATCH_SIZE, keys_only=True)
+        futures.extend(ndb.delete_multi_async(vote_keys))
+        more = more or len(vote_keys) == DELETE_BATCH_SIZE
+        if not more:
+            counter_names.extend([counter_name('num_comments', discussion_key),
+                                  counter_name('hot_votes', discussion_key)])
+    else:
+        if greeting_keys:
+            vote_keys = yield CommentVote.query(
+                CommentVote.comment.IN(greeting_keys)).fetch_async(keys_only=True)
+            futures.extend(ndb.delete_multi_async(vote_keys))
+        discussion = yield discussion_key.get_async()
+        if greeting_keys and discussion:
+            totals = yield counter_totals_async([discussion], 'num_comments')
+            uncounted = min(len(greeting_keys), totals[discussion_key]['num_comments'])
+            if uncounted > 0:
+                futures.append(count_async('num_comments', discussion_key, -uncounted))
+        if greeting_keys or photo_keys:
+            futures.append(forget_deleted_async(discussion_key, len(greeting_keys),
+                                                set(photo_keys)))
+    futures.append(counters.delete_async(counter_names))
+    futures.append(search_index.remove_async(
+        [key for key in keys if key.kind() in ('Discussion', 'Greeting')]))
+    yield futures
+
+    originals = [photo.original for photo in photos if photo and photo.original]
+    if originals:
+        yield blobstore.delete_async(originals)
+    yield bump_cache_version_async(FRONT_PAGE_SCOPE, discussion_scope(discussion_key))
+
+    raise ndb.Return((next_cursor or cursor) if more else None)
+
+
+def delete_tree_task(root_key, discussion_key, cursor, batch):
+    """Return the task deleting the next batch of a tree, named for its batch."""
+    name = 'delete-%s-%d' % (hashlib.sha1(root_key.urlsafe()).hexdigest(), batch)
+    return taskqueue.Task(url='/tasks/delete_tree', name=name, params={
+        'root_key': root_key.urlsafe(),
+        'discussion_key': discussion_key.urlsafe(),
+        'cursor': cursor.urlsafe(),
+        'batch': batch,
+    })
+
+
+@ndb.tasklet
+def delete_tree_async(root_key, discussion_key):
+    """Delete root_key and everything beneath it.
+
+    The first batch, root included, goes at once; anything left is deleted
+    by a chain of /tasks/delete_tree tasks.
+    """
+    cursor = yield delete_tree_batch_async(root_key, discussion_key)
+    if cursor:
+        try:
+            yield taskqueue.Queue().add_async(
+                delete_tree_task(root_key, discussion_key, cursor, 1))
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            # An earlier request already started deleting this tree
+            pass
+
+
 class MainPage(webapp2.RequestHandler):
+    @ndb.toplevel
     def get(self):
         
-        discussions = Discussion.query().order(-Discussion.date).fetch(100)           
-        
-        # If there are no discussions, create the welcome discussion
-        if not discussions:
-            discussion = Discussion(title='Welcome - What is medReach?', medical_category='general', num_comments=0)
-            key = discussion.put()
-            discussions = Discussion.query().fetch(100)
-            greeting = Greeting(parent=key)
-            greeting.author = Author(email='medReach')
-            greeting.content = 'Welcome to medReach'
-            greeting.put()
+        # The discussion list is shared by every reader, so serve it from memcache
+        category = self.request.get('category')
+        if category not in MEDICAL_CATEGORIES:
+            category = None
+        sort = self.request.get('sort')
+        if sort not in FRONT_PAGE_SORTS:
+            sort = FRONT_PAGE_SORTS[0]
+        page_size = page_size_param(self.request, DISCUSSIONS_PER_PAGE, MAX_DISCUSSIONS_PER_PAGE,
+                                    name='page_size')
+        cursor = cursor_param(self.request)
+        rows_future = render_fragment_async(
+            FRONT_PAGE_SCOPE, 'list:%s:%s:%d:%s' % (category, sort, page_size, self.request.get('cursor')),
+            'discussion_list.html', lambda: front_page_values_async(category, sort, page_size, cursor),
+            cache_time=FRONT_PAGE_CACHE_TIME)
        
         # Get the medreach user entity (mrUser) associated to this google userID and update view state from the mrUser persistence
         user = users.get_current_user()
         if user:
-            q = ndb.gql("SELECT * FROM MrUser WHERE userid = :1", user.user_id())
-            mrUser = q.get()
-            if not mrUser:
-                mrUser = MrUser(userid = user.user_id(), avatar = None)  # Put the avatar default here
-                mrUser.put()
+            mrUser = yield get_mr_user_async(user.user_id(), create=True)
             currentDiscussion = mrUser.currentDiscussionKey
+        discussion_rows = yield rows_future
 
         if user:
             url = users.create_logout_url(self.request.uri)
@@ -125,7 +1104,7 @@ class MainPage(webapp2.RequestHandler):
 
         template_values = {
             'user': user,
-            'discussions': discussions,
+            'discussion_rows': discussion_rows,
 #            'discussion_name': urllib.quote_plus(discussion_name),
             'url': url,
             'url_linktext': url_linktext,
@@ -135,39 +1114,39 @@ class MainPage(webapp2.RequestHandler):
         self.response.write(template.render(template_values))
         
 class DiscussionPage(webapp2.RequestHandler):
+    @ndb.toplevel
     def get(self):
         #Convert the key string to an entity key
         discussion_key = self.request.get('discussion_key')
         key = ndb.Key(urlsafe=discussion_key)
+        user = users.get_current_user()
+        # The page polls /api/thread for changes from here on
+        thread_version = current_version()
+
+        # The RPCs below are independent, so start them all before waiting on any.
+        # Photo upload URLs are fetched from /upload_urls only once a reader
+        # opens a photo form.
 
         #Get the discussion
-        discussion = key.get()
-        discussion_title = discussion.title
-        
-        # Get the list of greetings in sorted order
-        greetings = Greeting.query(ancestor=key).order(Greeting.date).fetch(100)
+        discussion_future = key.get_async()
         
-        # Create a jagged 2D list-of-lists with comments and sub-comments
-        # Sub-greetings are discovered via their parent key relationship to the parent greeting
-        greeting_list = []
-        index = 0
-        for greeting in greetings:
-            if not greeting.subcomment:  # Skip the subcomments or you'll get duplicates
-                greeting_list.append([])  # Append a list to the list to make it 2D
-                subgreetings = Greeting.query(ancestor=greeting.key).order(Greeting.date).fetch(100)
-                for subgreeting in subgreetings:
-                    greeting_list[index].append(subgreeting)  # may have to iterate to add to this list
-                index += 1               
-    
-        user = users.get_current_user()
+        # Get one page of comments grouped into a jagged 2D list-of-lists
+        limit = page_size_param(self.request, COMMENTS_PER_PAGE, COMMENTS_PER_PAGE)
+        cursor = cursor_param(self.request)
+        thread_future = render_fragment_async(
+            discussion_scope(key), 'thread:%d:%s' % (limit, self.request.get('cursor')),
+            'comment_thread.html',
+            lambda: comment_thread_values_async(key, limit, cursor))
+
         if user:
-            q = ndb.gql("SELECT * FROM MrUser WHERE userid = :1", user.user_id())
-            mrUser = q.get()
+            mrUser, my_votes = yield (get_mr_user_async(user.user_id()),
+                                      discussion_votes_async(user.user_id(), key))
         else:
             mrUser = None
+            my_votes = {}
 
-        #Get the upload endpoint URL for the photo upload
-        upload_url = blobstore.create_upload_url('/discussion?discussion_key=' + key.urlsafe())
+        discussion, comment_thread = yield discussion_future, thread_future
+        discussion_title = discussion.title
 
         if user:
             url = users.create_logout_url(self.request.uri)
@@ -179,64 +1158,119 @@ class DiscussionPage(webapp2.RequestHandler):
         template_values = {
             'user': user,
             'mr_user': mrUser,
-            'greeting_list': greeting_list,
+            'comment_thread': comment_thread,
+            'my_votes': jinja2.Markup(json.dumps(my_votes)),
+            'thread_version': thread_version,
             'discussion': discussion,
             'discussion_title': discussion_title,
             'url': url,
             'url_linktext': url_linktext,
-            'upload_url': upload_url,
+            'max_upload_urls': MAX_UPLOAD_URLS,
         }
 
         template = JINJA_ENVIRONMENT.get_template('discussion.html')
         self.response.write(template.render(template_values))
 
+class UploadUrls(webapp2.RequestHandler):
+    """Issue blobstore upload URLs for photo forms as JSON.
+
+    Each URL takes a single upload, so ?count= asks for up to
+    MAX_UPLOAD_URLS of them; their RPCs all run at once.
+    """
+    def get(self):
+        count = page_size_param(self.request, 1, MAX_UPLOAD_URLS, name='count')
+        rpcs = [blobstore.create_upload_url_async('/upload_img')
+                for _ in range(count)]
+        upload_urls = [rpc.get_result() for rpc in rpcs]
+
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.headers['Cache-Control'] = 'private, no-store'
+        self.response.write(json.dumps({
+            'upload_urls': upload_urls,
+            'expires_in': UPLOAD_URL_LIFETIME,
+        }))
+
 class Avatar(webapp2.RequestHandler):
     def get(self):   
         image_id = self.request.get('img_id')
 
+        # Versioned URLs carry the avatar digest, so a matching ETag needs no lookup
+        version = self.request.get('v')
+        if version and version in self.request.if_none_match:
+            self.response.headers['ETag'] = '"%s"' % version
+            self.response.status = 304
+            return
+
         user = users.get_current_user()        
         
-        # The image id is the greeting key
-        if  image_id != None and image_id != 'None':
+        user_id = self.request.get('user_id')
+        if user_id:
+            mrUser = get_mr_user(user_id)
+        # Pages rendered before avatars were addressed by user link them by
+        # greeting key
+        elif  image_id != None and image_id != 'None':
             greeting_key = ndb.Key(urlsafe=image_id)
             greeting = greeting_key.get()
             authorId = greeting.author.identity
             
-            # This query gets the medreach user associated to the authorID which is a google userID
-            q = ndb.gql("SELECT * FROM MrUser WHERE userid = :1", authorId)
-            mrUser = q.get()
+            # Get the medreach user associated to the authorID which is a google userID
+            mrUser = get_mr_user(authorId)
         elif image_id == None or image_id == 'None' and user:
             # If there is no greeting, then use the current users's avatar
-            q = ndb.gql("SELECT * FROM MrUser WHERE userid = :1", user.user_id())
-            mrUser = q.get()
+            mrUser = get_mr_user(user.user_id())
         else:
             mrUser = None
         
-        if mrUser and mrUser.avatar:
-            self.response.headers['Content-Type'] = 'image/png'
-            self.response.out.write(mrUser.avatar)
+        if mrUser and self.request.get('size') == '64' and mrUser.avatar_64:
+            avatar = mrUser.avatar_64
+        elif mrUser:
+            avatar = mrUser.avatar
+        else:
+            avatar = None
+
+        if avatar:
+            digest = image_digest(avatar)
+            max_age = IMMUTABLE_MAX_AGE if version == digest else MUTABLE_MAX_AGE
+            # The current user's avatar URL is shared by everyone, so keep it private
+            scope = 'public' if image_id != 'None' else 'private'
+            write_cached_image(self, avatar, digest,
+                               '%s, max-age=%d' % (scope, max_age))
         else:
             self.response.out.write('No image')
             
-class PostAvatar(webapp2.RequestHandler):
+class PostAvatar(blobstore_handlers.BlobstoreUploadHandler):
+    @ndb.toplevel
     def post(self):
         try:
             user = users.get_current_user()
+            uploads = self.get_uploads('img')
 
-            if user:
-                q = ndb.gql("SELECT * FROM MrUser WHERE userid = :1", user.user_id())
-                mrUser = q.get()
-            else:
+            if not user:
+                # Nobody to give the upload to
+                if uploads:
+                    yield blobstore.delete_async([upload.key() for upload in uploads])
+                self.error(401)
                 self.response.out.write('Please Login')
+                return
+            mrUser = yield get_mr_user_async(user.user_id(), create=True)
 
-            if self.request.get('img'):
-                avatar = self.request.get('img')
-                avatar = images.resize(avatar, 32, 32)
-                mrUser.avatar = avatar
-                mrUser.put()
+            # Keep the original in the blobstore; the sized avatars are
+            # rendered by tasks and the old ones are shown until then.  Tasks
+            # still rendering the old original find it replaced and stop.
+            old_original = mrUser.avatar_original
+            if uploads:
+                mrUser.avatar_original = uploads[0].key()
+                yield mrUser.put_async()
+                yield imaging.queue_renditions_async('/tasks/render_avatar', imaging.AVATAR_RENDITIONS,
+                                                     user_id=user.user_id(),
+                                                     original=str(mrUser.avatar_original))
             else:
-                mrUser.avatar = Null  #Null is used as a switch for the glyph
-                mrUser.put()
+                mrUser.avatar = None  #None is used as a switch for the glyph
+                mrUser.avatar_64 = None
+                mrUser.avatar_original = None
+                yield mrUser.put_async()
+            if old_original:
+                yield blobstore.delete_async(old_original)
 
             self.redirect('/settings')
         except:
@@ -245,6 +1279,7 @@ class PostAvatar(webapp2.RequestHandler):
 # DeleteDiscussion - can be when the last greeting is deleted or it can be a single delete function with a parameter.
 # Or it can be based on the key type - can that be discovered?
 class DeleteEntity(webapp2.RequestHandler):
+    @ndb.toplevel
     def post(self):
         try:
             del_type = self.request.get('del_type')
@@ -252,34 +1287,29 @@ class DeleteEntity(webapp2.RequestHandler):
 #                                               DEFAULT_DISCUSSION_NAME)
             discussion_key = self.request.get('discussion_key')
             disc_key = ndb.Key(urlsafe=discussion_key)
-            discussion = disc_key.get()
             
+            # Deleting a discussion or comment takes its replies and photos along
             if del_type == 'discussion':
-                disc_key.delete()
-                self.redirect('/')
+                yield delete_tree_async(disc_key, disc_key)
+                if self.request.get('format') == 'json':
+                    write_json(self, {'deleted': [disc_key.urlsafe()]})
+                else:
+                    self.redirect('/')
                 
             elif del_type == 'greeting':
-                if discussion.num_comments > 0:
-                    discussion.num_comments -= 1
-                    discussion.put()
-
                 greeting_key = self.request.get('greeting_key')
                 key = ndb.Key(urlsafe=greeting_key)
-                key.delete()
-
-                greetings = Greeting.query(ancestor=disc_key).fetch(100) 
-                if not greetings:
-                    # If you want to automatically remove a discussion when there are
-                    # no comments left, uncomment the two lines below and remove the redirect
-#                    disc_key.delete()
-#                    self.redirect('/')
-                    self.redirect('/discussion?discussion_key=' + disc_key.urlsafe())
-                else:
-                    self.redirect('/discussion?discussion_key=' + disc_key.urlsafe())
+                if key.pairs()[:len(disc_key.pairs())] != disc_key.pairs():
+                    self.error(400)
+                    return
+                yield delete_tree_async(key, disc_key)
+                yield record_change_async(disc_key, key, deleted=True)
+                yield finish_thread_write_async(self, disc_key)
         except:
             self.error(500)
 
 class PostDiscussion(webapp2.RequestHandler):
+    @ndb.toplevel
     def post(self):
         try:
             if self.request.get('disc-title'):
@@ -301,7 +1331,10 @@ class PostDiscussion(webapp2.RequestHandler):
                 discussion.owner = Owner(email='anonymous')
                 
             if discussion.title:
-                key = discussion.put()
+                key = yield save_discussion_async(discussion)
+                index_rpc = search_index.queue_update_async(key)
+                yield bump_cache_version_async(FRONT_PAGE_SCOPE)
+                yield index_rpc
                 self.redirect('/discussion?discussion_key=' + key.urlsafe())
             else:
                 self.redirect('/')
@@ -309,11 +1342,12 @@ class PostDiscussion(webapp2.RequestHandler):
             self.error(500)
             
 class UpdateDiscussion(webapp2.RequestHandler):
+    @ndb.toplevel
     def post(self):
 #        try:
             discussion_key = self.request.get('discussion_key')
             disc_key = ndb.Key(urlsafe=discussion_key)
-            discussion = disc_key.get()
+            discussion = yield disc_key.get_async()
             
             if self.request.get('content'):
                 discussion.content = self.request.get('content')
@@ -322,26 +1356,27 @@ class UpdateDiscussion(webapp2.RequestHandler):
             if self.request.get('medical-category'):
                 discussion.medical_category = self.request.get('medical-category')
                 
-            discussion.put()
-            self.redirect('/discussion?discussion_key=' + discussion.key.urlsafe())
+            yield save_discussion_async(discussion)
+            # Comments are indexed with their discussion's title and category
+            index_rpc = search_index.queue_update_async(disc_key, cascade=True)
+            yield [record_change_async(disc_key, disc_key)] + bump_cache_version_async(
+                FRONT_PAGE_SCOPE, discussion_scope(disc_key))
+            yield index_rpc
+            yield finish_thread_write_async(self, disc_key)
 
 #        except:
 #            self.error(500)
             
 class PostGreeting(webapp2.RequestHandler):
+    @ndb.toplevel
     def post(self):
 #        try:
             discussion_key = self.request.get('discussion_key')
             disc_key = ndb.Key(urlsafe=discussion_key)
-            discussion = disc_key.get()
             
-            # Get the discussion and update the comment count
+            # Get the parent of the new comment
             parent_key = self.request.get('key')
             key = ndb.Key(urlsafe=parent_key)
-            parent = key.get()
-            if discussion.num_comments == None:
-                discussion.num_comments = 0
-            discussion.num_comments += 1
 #            if self.request.get('parent') == 'discussion':
 #                #parent is a discussion
 #                #todo:  fix this - this can be polymorphic
@@ -353,113 +1388,71 @@ class PostGreeting(webapp2.RequestHandler):
             elif self.request.get('parent') == 'greeting':
                 greeting = Greeting(parent=key, upvotes=0, downvotes=0, subcomment=True)
 
-            # Set the author ID
+            # Set the author ID, reading the discussion while making sure the
+            # author's MrUser exists
             user = users.get_current_user()
             if user:
                 greeting.author = Author(
                         identity=users.get_current_user().user_id(),
                         email=users.get_current_user().email())
-                q = ndb.gql("SELECT * FROM MrUser WHERE userid = :1", user.user_id())
-                mrUser = q.get()
-                
-                # Set the avatar (if present)
-                if self.request.get('img'):
-                    avatar = self.request.get('img')
-                    avatar = images.resize(avatar, 32, 32)
-                    mrUser.avatar = avatar
-                    
-                # Update the users comment count
-                if mrUser:
-                    if mrUser.num_comments == None:
-                        mrUser.num_comments = 0
-                    mrUser.num_comments += 1
-                    mrUser.put()
-                
+                discussion, mrUser = yield (disc_key.get_async(),
+                                            get_mr_user_async(user.user_id(), create=True))
+            else:
+                discussion = yield disc_key.get_async()
                     
             # Set the content
             greeting.content = self.request.get('content')
 
-#            # Send email notification
-#            # Create message container - the correct MIME type is multipart/alternative.
-##            msg = MIMEMultipart('alternative')
-#            msg = MIMEText(greeting.content)
-#            msg['Subject'] = "Someone Responded to You on medReach"
-            sender_addr = 'glengoffin3@gmail.com'
-#            sender_addr = 'noreply@medreach.appspotmail.com'
-#            sender_addr = 'medreach-1080@appspot.gserviceaccount.com'
-#            sender_addr = 'medreach-1080@appspot.gserviceaccount.com'
-            url_link = 'http://medreach-1080.appspot.com/discussion?discussion_key=' + discussion.key.urlsafe()
-#            msg['From'] = sender
-            if discussion.owner and discussion.owner != 'anonymous':
-                recipient_addr = discussion.owner.email
-                print discussion.owner.email
-            else:
-                recipient_addr = None
-                
-#            html = """\
-#                    <html>
-#                      <head></head>
-#                      <body>
-#                        <p>Hi!<br>
-#                           %s has responded to your post titled: "%s"<br>
-#                           Here's what they said: "%s"
-#                           Visit the site %s
-#                        </p>
-#                      </body>
-#                    </html>
-#                    """ % (greeting.author.email, discussion.title, greeting.content, url_link)
-#            
-#            text = ("""%s has responded to your post titled, " %s "  \nHere's what they said: " %s "  \nVisit the site %s.
-#                    """ % (greeting.author.email, discussion.title, greeting.content, url_link))
+            yield add_comment_async(greeting, disc_key)
+            index_rpc = search_index.queue_update_async(greeting.key)
 
-                
-#            msg['To'] = recipient
-#
-#            # Send the message via our own SMTP server, but don't include the
-#            # envelope header.
-#            try:
-#                s = smtplib.SMTP('localhost')
-#                s.sendmail(sender, recipient, msg.as_string())
-#                s.quit()
-#            except Exception, e: 
-#                print e
-#                print 'ERROR: Unable to send email'
-            if not user or user.user_id() == recipient_addr or recipient_addr == None:
-                print 'no email'
-            else:
-                try:    
-                    mail.send_mail(sender=sender_addr,
-                                  to=recipient_addr,
-                                  subject="%s Replied to You on MedReach" % greeting.author.email,
-                                  body="""%s has responded to your post titled, "%s"  \nHere's what they said: "%s"  \nVisit the site %s.
-                                        """ % (greeting.author.email, discussion.title, greeting.content, url_link))
-                except Exception, e:
-                    print e
-                    print 'Error: Unable to send email'
-#            """
-#            Dear Albert:
-#
-#            Your example.com account has been approved.  You can now visit
-#            http://www.example.com/ and sign in using your Google Account to
-#            access new features.
-#
-#            Please let us know if you have any questions.
-#
-#            The example.com Team
-#            """
-                
+            # Update the discussion and user comment counts and email the
+            # discussion owner from the task queue, all at once
+            futures = [count_async('num_comments', disc_key)]
+            if user:
+                futures.append(count_async('num_comments', mr_user_key(user.user_id())))
+            if user and discussion.owner and discussion.owner.email not in (None, 'anonymous', user.email()):
+                futures.append(notifications.queue_reply_async(discussion.owner.email, discussion, greeting))
+            yield futures
+            yield index_rpc
 
-            greeting.put()
-            discussion.put()  # Updates to num_comments needed to be posted
+            # Only log the change and invalidate once the new counts are visible
+            yield [record_change_async(disc_key, greeting.key)] + bump_cache_version_async(
+                FRONT_PAGE_SCOPE, discussion_scope(disc_key))
 
-            self.redirect('/discussion?discussion_key=' + discussion.key.urlsafe())
+            yield finish_thread_write_async(self, disc_key)
 #        except:
 #            self.error(500)
 
-#Todo:  Change this to GetPhoto()
-class Photo(webapp2.RequestHandler):
+class GetPhoto(webapp2.RequestHandler):
     def get(self):
-        #The imageID is the greeting ID
+        #Photos are read straight from their own entity
+        if self.request.get('photo_key'):
+            photo_key = ndb.Key(urlsafe=self.request.get('photo_key'))
+            size = self.request.get('size')
+            if size in imaging.RENDITIONS:
+                rendition = ndb.Key(PhotoRendition, size, parent=photo_key).get()
+                if rendition:
+                    # Renditions are never rewritten, so their URL is immutable
+                    write_cached_image(self, rendition.data, rendition.digest,
+                                       'public, max-age=%d' % IMMUTABLE_MAX_AGE)
+                    return
+
+            photo = photo_key.get()
+            if photo and photo.data:
+                # Photos from before renditions have a single size
+                write_cached_image(self, photo.data,
+                                   photo.digest or image_digest(photo.data),
+                                   'public, max-age=%d' % IMMUTABLE_MAX_AGE)
+            elif photo and photo.original:
+                # Still rendering; don't let anyone cache the placeholder
+                self.response.headers['Cache-Control'] = 'no-cache'
+                self.redirect('/img/loading.gif')
+            else:
+                self.response.out.write('No image')
+            return
+
+        #Legacy URL: the imageID is the greeting ID
         entity_key = ndb.Key(urlsafe=self.request.get('img_id'))
         entity = entity_key.get()
         
@@ -468,42 +1461,48 @@ class Photo(webapp2.RequestHandler):
         loop_index -= 1
 
         if entity.photos[loop_index]:
-            self.response.headers['Content-Type'] = 'image/png'
-            self.response.out.write(entity.photos[loop_index])
+            photo = entity.photos[loop_index]
+            write_cached_image(self, photo, image_digest(photo),
+                               'public, max-age=%d' % MUTABLE_MAX_AGE)
         else:
             self.response.out.write('No image')
 
-class PostPhoto(webapp2.RequestHandler):
+class PostPhoto(blobstore_handlers.BlobstoreUploadHandler):
+    @ndb.toplevel
     def post(self):
         try:
             discussion_key = self.request.get('discussion_key')
             disc_key = ndb.Key(urlsafe=discussion_key)
-            discussion = disc_key.get()
             
             greeting_key = self.request.get('greeting_key')
             key = ndb.Key(urlsafe=greeting_key)
-            greeting = key.get()
 
-            #Add photo to greeting entity
-            if self.request.get('photo'):
-                photo = self.request.get('photo')
-                photo = images.resize(photo, width=400)
-                greeting.photos.append(photo)
-            
-                #Add smaller version of photo to discussion gallery
-                photo = images.resize(photo, 130, 160)
-                discussion.photos.append(photo)
-            
-                greeting.put()
-                discussion.put()
+            #Store the original once as a child of the greeting; the greeting
+            #and the discussion gallery show different renditions of it
+            uploads = self.get_uploads('photo')
+            if uploads:
+                photo = Photo(parent=key, original=uploads[0].key(),
+                              content_type=uploads[0].content_type)
+                photo_key = yield attach_photo_async(photo, key, disc_key)
+                if photo_key is None:
+                    # The comment was deleted while the photo was uploading
+                    yield blobstore.delete_async(photo.original)
+                    self.error(404)
+                    return
+                render_rpc = imaging.queue_renditions_async('/tasks/render_photo', imaging.PHOTO_RENDITIONS,
+                                                            photo_key=photo_key.urlsafe())
+                yield [record_change_async(disc_key, key)] + bump_cache_version_async(
+                    FRONT_PAGE_SCOPE, discussion_scope(disc_key))
+                yield render_rpc
 
-            self.redirect('/discussion?discussion_key=' + disc_key.urlsafe())
+            yield finish_thread_write_async(self, disc_key)
         except:
             self.error(500)
 
 #  TODO: Need to find way to print to console in python
 #  Need to print the userID and blobKey
 class Vote(webapp2.RequestHandler):
+    @ndb.toplevel
     def post(self):
 #        try:
             discussion_key = self.request.get('discussion_key')
@@ -511,72 +1510,155 @@ class Vote(webapp2.RequestHandler):
         
             greeting_key = self.request.get('greeting_key')
             key = ndb.Key(urlsafe=greeting_key)
-            greeting = key.get()
+            vote_type = self.request.get('vote_type')
             
             #Find the mrUser associatd to this google userID
-#            if greeting.author.identity:
-            # Set the author ID
             user = users.get_current_user()
             if user:
-                q = ndb.gql("SELECT * FROM MrUser WHERE userid = :1", user.user_id())
-                mrUser = q.get()
+                mrUser = yield get_mr_user_async(user.user_id(), create=True)
             else:
                 mrUser = None
+                if self.request.get('format') == 'json':
+                    self.error(403)
+                    return
                 
-            #Check to see if this person has already voted           
-            allow_vote = True
-            if mrUser != None:
-                for upvote_id in greeting.upvote_ids:
-                    if upvote_id == mrUser.key.id():
-                        allow_vote = False
-                for downvote_id in greeting.downvote_ids:
-                    if downvote_id == mrUser.key.id():
-                        allow_vote = False
-            else:
-                allow_vote = False
+            #Votes cast before CommentVote records existed live in the
+            #user's frozen vote id lists
+            allow_vote = mrUser != None and vote_type in ('up', 'down')
+            if allow_vote:
+                if key.id() in mrUser.upvote_ids or key.id() in mrUser.downvote_ids:
+                    allow_vote = False
                  
-            #Save the identities of the voters with the comment
-            if self.request.get('vote_type') == 'up':
-                
-                if allow_vote:
-                    greeting.upvote_ids.append(mrUser.key.id())
-                    if greeting.upvotes == None:
-                        greeting.upvotes = 1
-                    else:
-                        greeting.upvotes += 1
-                        
-                    mrUser.upvote_ids.append(greeting.key.id())
-                    if mrUser.upvotes == None:
-                        mrUser.upvotes = 1
-                    else:
-                        mrUser.upvotes += 1
-                        
-            elif self.request.get('vote_type') == 'down':
-                
-                if allow_vote:
-                    greeting.downvote_ids.append(mrUser.key.id())
-                    if greeting.downvotes == None:
-                        greeting.downvotes = 1
-                    else:
-                        greeting.downvotes += 1
-                        
-                    mrUser.downvote_ids.append(greeting.key.id())
-                    if mrUser.downvotes == None:
-                        mrUser.downvotes = 1
-                    else:
-                        mrUser.downvotes += 1
+            #Record the vote under the voter; a duplicate is a single key get
+            if allow_vote:
+                recorded = yield record_vote_async(user.user_id(), key, disc_key, vote_type)
+                if recorded:
+                    # Only counters are written, never the discussion's
+                    # entity group; the hot score catches up within a minute
+                    yield (count_async(vote_type + 'votes', key),
+                           count_async(vote_type + 'votes', mrUser.key),
+                           heat_vote_async(disc_key))
+                    yield [record_change_async(disc_key, key)] + bump_cache_version_async(
+                        discussion_scope(disc_key))
             
-            greeting.put()
-            if mrUser:
-                mrUser.put()
-            
-            self.redirect('/discussion?discussion_key=' + disc_key.urlsafe())
+            yield finish_thread_write_async(self, disc_key)
 
 #        except:
 #            self.error(500)
 
 
 
+class ThreadApi(webapp2.RequestHandler):
+    """A discussion's comments as JSON.
+
+    With ?since=<version>, only the comments, vote counts and deletions
+    changed since then; without, one page of comments like the discussion
+    page (?limit=, ?cursor=).  Either way the response carries the version
+    to poll with next.
+    """
+    @ndb.toplevel
+    def get(self):
+        discussion_key = ndb.Key(urlsafe=self.request.get('discussion_key'))
+        since = version_param(self.request)
+        if since is not None:
+            changes = yield thread_changes_async(discussion_key, since)
+            write_json(self, changes)
+            return
+
+        version = current_version()
+        discussion = yield discussion_key.get_async()
+        if discussion is None:
+            self.error(404)
+            return
+        limit = page_size_param(self.request, COMMENTS_PER_PAGE, COMMENTS_PER_PAGE)
+        greeting_list, next_cursor, more = yield load_comment_tree_async(
+            discussion_key, limit, cursor_param(self.request))
+        greetings = [greeting for thread in greeting_list for greeting in thread]
+        counts = yield counter_totals_async(greetings, 'upvotes', 'downvotes')
+        write_json(self, {
+            'version': version,
+            'discussion': discussion_json(discussion),
+            'greetings': [greeting_json(greeting, counts[greeting.key]) for greeting in greetings],
+            'next_cursor': next_cursor.urlsafe() if more and next_cursor else None,
+        })
+
+class SearchPage(webapp2.RequestHandler):
+    """Full-text search over discussions and comments, see search_index."""
+    def get(self):
+        query_string = self.request.get('q').strip()
+        category = self.request.get('category')
+        if category not in MEDICAL_CATEGORIES:
+            category = None
+        limit = page_size_param(self.request, search_index.RESULTS_PER_PAGE,
+                                search_index.MAX_RESULTS_PER_PAGE)
+
+        results, facets, next_cursor, error = [], [], None, None
+        if query_string:
+            from google.appengine.api import search
+            try:
+                results, facets, next_cursor = search_index.search_posts(
+                    query_string, category, limit, self.request.get('cursor') or None)
+            except search.QueryError:
+                error = 'Sorry, that search could not be understood.'
+
+        user = users.get_current_user()
+        if user:
+            url = users.create_logout_url(self.request.uri)
+            url_linktext = 'Logout'
+        else:
+            url = users.create_login_url(self.request.uri)
+            url_linktext = 'Login'
+
+        template_values = {
+            'query': query_string,
+            'query_param': urllib.urlencode({'q': query_string.encode('utf-8')}),
+            'category': category,
+            'limit': limit,
+            'results': results,
+            'facets': facets,
+            'next_cursor': next_cursor,
+            'error': error,
+            'url': url,
+            'url_linktext': url_linktext,
+        }
+
+        template = JINJA_ENVIRONMENT.get_template('search.html')
+        self.response.write(template.render(template_values))
+
+class MePage(webapp2.RequestHandler):
+    """The current user's own discussions, or their comments with ?show=replies"""
+    def get(self):
+        user = users.get_current_user()
+        if not user:
+            self.redirect(users.create_login_url(self.request.uri))
+            return
+
+        show = self.request.get('show')
+        if show not in ACTIVITY_VIEWS:
+            show = ACTIVITY_VIEWS[0]
+        page_size = page_size_param(self.request, DISCUSSIONS_PER_PAGE, MAX_DISCUSSIONS_PER_PAGE)
+        template_values = activity_values(user.user_id(), show, page_size,
+                                          cursor_param(self.request))
+        template_values.update({
+            'user': user,
+            'url': users.create_logout_url(self.request.uri),
+            'url_linktext': 'Logout',
+        })
+
+        template = JINJA_ENVIRONMENT.get_template('me.html')
+        self.response.write(template.render(template_values))
+
+class Warmup(webapp2.RequestHandler):
+    """Prepare a new instance before it is sent traffic (app.yaml warmup).
+
+    Loads every template and the APIs that are otherwise imported on first
+    use, so no user request pays for them.
+    """
+    def get(self):
+        for name in TEMPLATES:
+            JINJA_ENVIRONMENT.get_template(name)
+        from google.appengine.api import images, mail, search
+
 class AboutPage(webapp2.RequestHandler):
     def get(self):
 
@@ -584,21 +1666,23 @@ class AboutPage(webapp2.RequestHandler):
         self.response.write(template.render())
 
 class SettingsPage(webapp2.RequestHandler):
+    @ndb.toplevel
     def get(self):
 
         user = users.get_current_user()
         
-        # Find the mrUser record associated with this google userID
+        # Find the mrUser record associated with this google userID, and
+        # its counts, while the avatar upload URL is being created
         if user:
-            q = ndb.gql("SELECT * FROM MrUser WHERE userid = :1", user.user_id())
-            mrUser = q.get() 
-            if self.request.get('img'):
-                avatar = self.request.get('img')
-                avatar = images.resize(avatar, 32, 32)
-                mrUser.avatar = avatar
-                mrUser.put()
+            upload_rpc = blobstore.create_upload_url_async('/upload_avatar')
+            mrUser = yield get_mr_user_async(user.user_id(), create=True)
+            user_counts = yield counter_totals_async([mrUser], 'upvotes', 'downvotes', 'num_comments')
+            user_counts = user_counts[mrUser.key]
+            upload_url = yield upload_rpc
         else:
             mrUser = None
+            user_counts = None
+            upload_url = None
 
         if user:
             url = users.create_logout_url(self.request.uri)
@@ -607,9 +1691,14 @@ class SettingsPage(webapp2.RequestHandler):
             url = users.create_login_url(self.request.uri)
             url_linktext = 'Login'
         
+        avatar_url = avatar_src(user.user_id(), mrUser) if user else None
+
         template_values = {
             'user': user,
             'mrUser': mrUser,
+            'avatar_url': avatar_url,
+            'user_counts': user_counts,
+            'upload_url': upload_url,
             'url': url,
             'url_linktext': url_linktext,
         }
@@ -618,18 +1707,342 @@ class SettingsPage(webapp2.RequestHandler):
         self.response.write(template.render(template_values))
         
 
+class RenderPhoto(webapp2.RequestHandler):
+    """Task: render one size of an uploaded photo from its original."""
+    def post(self):
+        photo = ndb.Key(urlsafe=self.request.get('photo_key')).get()
+        if not photo or not photo.original:
+            return
+        data = imaging.render(photo.original, self.request.get('rendition'))
+        PhotoRendition(id=self.request.get('rendition'), parent=photo.key,
+                       data=data, digest=image_digest(data)).put()
+
+@ndb.transactional
+def store_avatar_rendition(user_id, original, rendition, data):
+    """Save an avatar rendition unless a newer avatar was uploaded meanwhile."""
+    mr_user = mr_user_key(user_id).get()
+    if mr_user and str(mr_user.avatar_original) == original:
+        setattr(mr_user, rendition, data)
+        mr_user.put()
+
+class RenderAvatar(webapp2.RequestHandler):
+    """Task: render one size of a user's uploaded avatar from its original."""
+    def post(self):
+        original = self.request.get('original')
+        rendition = self.request.get('rendition')
+        if rendition not in imaging.AVATAR_RENDITIONS:
+            return
+        mr_user = get_mr_user(self.request.get('user_id'))
+        if not mr_user or str(mr_user.avatar_original) != original:
+            # Replaced by a newer upload, which deleted this original
+            return
+        data = imaging.render(blobstore.BlobKey(original), rendition)
+        store_avatar_rendition(self.request.get('user_id'), original, rendition, data)
+
+
+class MigrateUsers(webapp2.RequestHandler):
+    """One-off migration of query-keyed MrUser rows to user-id keys.
+
+    Merges one batch per request into the keyed rows and chains the next
+    batch through the task queue until every legacy row is gone.
+    """
+    def get(self):
+        self.post()
+
+    def post(self):
+        cursor = None
+        if self.request.get('cursor'):
+            cursor = ndb.Cursor(urlsafe=self.request.get('cursor'))
+        rows, next_cursor, more = MrUser.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor)
+
+        legacy = [row for row in rows
+                  if row.userid and row.key != mr_user_key(row.userid)]
+        if legacy:
+            keyed = {}
+            targets = ndb.get_multi([mr_user_key(row.userid) for row in legacy])
+            for row, target in zip(legacy, targets):
+                target = keyed.get(row.userid) or target
+                if target is None:
+                    target = MrUser(key=mr_user_key(row.userid), userid=row.userid)
+                merge_mr_users(target, row)
+                keyed[row.userid] = target
+            ndb.put_multi(keyed.values())
+            ndb.delete_multi([row.key for row in legacy])
+
+        if more and next_cursor:
+            taskqueue.add(url='/admin/migrate_users',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.write('Migrated %d users' % len(legacy))
+
+
+class MigrateCounters(webapp2.RequestHandler):
+    """One-off fold of counter shards beyond their counter's shard count.
+
+    Needed once counters.FIELD_SHARDS lowers a field's shard count, as reads
+    no longer see the shards beyond it; chains the next batch through the
+    task queue.
+    """
+    def get(self):
+        self.post()
+
+    @ndb.toplevel
+    def post(self):
+        cursor = None
+        if self.request.get('cursor'):
+            cursor = ndb.Cursor(urlsafe=self.request.get('cursor'))
+        keys, next_cursor, more = yield counters.CounterShard.query().fetch_page_async(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        folded = yield counters.fold_extra_shards_async(keys)
+
+        if more and next_cursor:
+            taskqueue.add(url='/admin/migrate_counters',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.write('Folded %d counter shards' % folded)
+
+
+class BuildSummaries(webapp2.RequestHandler):
+    """One-off backfill of DiscussionSummary rows for existing discussions.
+
+    Rebuilds one batch of summaries per request, counting comments and
+    finding the latest reply, and chains the next batch through the task
+    queue.
+    """
+    def get(self):
+        self.post()
+
+    def post(self):
+        cursor = None
+        if self.request.get('cursor'):
+            cursor = ndb.Cursor(urlsafe=self.request.get('cursor'))
+        discussions, next_cursor, more = Discussion.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor)
+
+        latest = [Greeting.query(ancestor=discussion.key).order(-Greeting.date).get_async()
+                  for discussion in discussions]
+        counts = counter_totals(discussions, 'num_comments')
+        summaries = []
+        for discussion, greeting in zip(discussions, latest):
+            summary = summarize(discussion)
+            summary.num_comments = counts[discussion.key]['num_comments']
+            greeting = greeting.get_result()
+            if greeting:
+                summary.last_activity = greeting.date
+                summary.last_author_email = greeting.author.email if greeting.author else None
+            # Without the history, score every comment as of the latest one
+            summary.hot = HOT_DISCUSSION_POINTS + HOT_COMMENT_POINTS * summary.num_comments
+            summary.hot_date = summary.last_activity
+            summaries.append(summary)
+        ndb.put_multi(summaries)
+        if summaries:
+            bump_cache_version(FRONT_PAGE_SCOPE)
+
+        if more and next_cursor:
+            taskqueue.add(url='/admin/build_summaries',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.write('Built %d discussion summaries' % len(summaries))
+
+
+class IndexActivity(webapp2.RequestHandler):
+    """One-off backfill of the ids the /me page queries on.
+
+    Comments written while Author.identity was unindexed are put again to
+    index it, then summaries get their discussion's owner_id and votes the
+    comment they are on, so deleting a comment finds them; one batch of
+    each kind in turn per request, chained through the task queue.
+    """
+    def get(self):
+        self.post()
+
+    def post(self):
+        kind = self.request.get('kind') or 'Greeting'
+        cursor = None
+        if self.request.get('cursor'):
+            cursor = ndb.Cursor(urlsafe=self.request.get('cursor'))
+
+        if kind == 'Greeting':
+            entities, next_cursor, more = Greeting.query().fetch_page(
+                MIGRATION_BATCH_SIZE, start_cursor=cursor)
+        elif kind == 'CommentVote':
+            votes, next_cursor, more = CommentVote.query().fetch_page(
+                MIGRATION_BATCH_SIZE, start_cursor=cursor)
+            entities = [vote for vote in votes if not vote.comment]
+            for vote in entities:
+                vote.comment = ndb.Key(urlsafe=vote.key.id())
+        else:
+            discussions, next_cursor, more = Discussion.query().fetch_page(
+                MIGRATION_BATCH_SIZE, start_cursor=cursor)
+            summaries = ndb.get_multi([summary_key(discussion.key) for discussion in discussions])
+            entities = [summarize(discussion, summary)
+                        for discussion, summary in zip(discussions, summaries) if summary]
+        ndb.put_multi(entities)
+
+        if more and next_cursor:
+            taskqueue.add(url='/admin/index_activity',
+                          params={'kind': kind, 'cursor': next_cursor.urlsafe()})
+        elif kind == 'Greeting':
+            taskqueue.add(url='/admin/index_activity', params={'kind': 'DiscussionSummary'})
+        elif kind == 'DiscussionSummary':
+            taskqueue.add(url='/admin/index_activity', params={'kind': 'CommentVote'})
+        self.response.write('Indexed %d %s entities' % (len(entities), kind))
+
+
+class MigratePhotos(webapp2.RequestHandler):
+    """One-off migration of embedded Discussion/Greeting photos to Photo entities.
+
+    Walks Discussion and then Greeting in batches, chaining itself through
+    the task queue with a cursor.
+    """
+    kinds = [Discussion, Greeting]
+
+    def get(self):
+        self.post()
+
+    def post(self):
+        kind_index = int(self.request.get('kind', 0))
+        model = self.kinds[kind_index]
+        cursor = None
+        if self.request.get('cursor'):
+            cursor = ndb.Cursor(urlsafe=self.request.get('cursor'))
+        rows, next_cursor, more = model.query().fetch_page(
+            PHOTO_MIGRATION_BATCH_SIZE, start_cursor=cursor)
+
+        migrated = [row for row in rows if row.photos]
+        for row in migrated:
+            move_embedded_photos(row)
+        ndb.put_multi(migrated)
+        # Cached fragments still link the legacy photo URLs
+        if migrated:
+            bump_cache_version(FRONT_PAGE_SCOPE, *set(
+                discussion_scope(ndb.Key(pairs=row.key.pairs()[:1])) for row in migrated))
+
+        if more and next_cursor:
+            taskqueue.add(url='/admin/migrate_photos',
+                          params={'kind': kind_index, 'cursor': next_cursor.urlsafe()})
+        elif kind_index + 1 < len(self.kinds):
+            taskqueue.add(url='/admin/migrate_photos', params={'kind': kind_index + 1})
+        self.response.write('Migrated photos of %d %s entities' % (len(migrated), model.__name__))
+
+
+class DecayHot(webapp2.RequestHandler):
+    """Cron: decay every discussion's hot score to now, one batch per request.
+
+    Writes only ever raise scores, so this is what lets quiet discussions
+    sink.  Scores are walked from the lowest up; a decayed one only moves
+    further behind the cursor.  The next batch is chained through the task
+    queue, and the last one refreshes the cached front page.
+    """
+    def get(self):
+        self.post()
+
+    @ndb.toplevel
+    def post(self):
+        cursor = None
+        if self.request.get('cursor'):
+            cursor = ndb.Cursor(urlsafe=self.request.get('cursor'))
+        now = datetime.datetime.utcnow()
+        query = DiscussionSummary.query(DiscussionSummary.hot > 0).order(DiscussionSummary.hot)
+        keys, next_cursor, more = yield query.fetch_page_async(
+            HOT_DECAY_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        yield [decay_heat_async(key, now) for key in keys]
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/decay_hot', params={'cursor': next_cursor.urlsafe()})
+        else:
+            yield bump_cache_version_async(FRONT_PAGE_SCOPE)
+
+class PruneChanges(webapp2.RequestHandler):
+    """Cron: delete thread changes older than CHANGE_RETENTION, one batch per request.
+
+    The next batch is chained through the task queue.
+    """
+    def get(self):
+        self.post()
+
+    def post(self):
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=CHANGE_RETENTION)
+        keys = ThreadChange.query(ThreadChange.date < cutoff).fetch(
+            DELETE_BATCH_SIZE, keys_only=True)
+        ndb.delete_multi(keys)
+        if len(keys) == DELETE_BATCH_SIZE:
+            taskqueue.add(url='/tasks/prune_changes')
+
+class FoldVotes(webapp2.RequestHandler):
+    """Task: fold a discussion's votes into its hot score, see heat_vote_async().
+
+    Votes counted while it ran found this task already scheduled, so if the
+    count moved on meanwhile the next window's fold is scheduled.
+    """
+    @ndb.toplevel
+    def post(self):
+        discussion_key = ndb.Key(urlsafe=self.request.get('discussion_key'))
+        name = counter_name('hot_votes', discussion_key)
+        counts = yield counters.read_counts_async([name])
+        yield fold_votes_async(discussion_key, counts[name])
+
+        latest = yield counters.read_counts_async([name])
+        if latest[name] != counts[name]:
+            window = self.request.get('window')
+            yield schedule_fold_votes_async(discussion_key, int(window) if window else None)
+
+class DeleteTree(webapp2.RequestHandler):
+    """Task: delete the next batch of a cascading delete and chain the rest."""
+    def post(self):
+        root_key = ndb.Key(urlsafe=self.request.get('root_key'))
+        discussion_key = ndb.Key(urlsafe=self.request.get('discussion_key'))
+        batch = int(self.request.get('batch'))
+        cursor = delete_tree_batch_async(
+            root_key, discussion_key,
+            ndb.Cursor(urlsafe=self.request.get('cursor'))).get_result()
+        if cursor:
+            try:
+                delete_tree_task(root_key, discussion_key, cursor, batch + 1).add()
+            except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+                # A retry of this batch already chained the next one
+                pass
+
+
 app = webapp2.WSGIApplication([
     ('/', MainPage),
     ('/discussion', DiscussionPage),
     ('/about', AboutPage),
+    ('/_ah/warmup', Warmup),
+    ('/search', SearchPage),
+    ('/me', MePage),
     ('/settings', SettingsPage),
     ('/img', Avatar),
+    ('/api/thread', ThreadApi),
     ('/upload_avatar', PostAvatar),
     ('/upload_img', PostPhoto),
-    ('/photo', Photo),
+    ('/upload_urls', UploadUrls),
+    ('/photo', GetPhoto),
     ('/post_new', PostDiscussion),
     ('/update', UpdateDiscussion),
     ('/sign', PostGreeting),
     ('/delete', DeleteEntity),
     ('/vote', Vote),
+    ('/admin/migrate_users', MigrateUsers),
+    ('/admin/migrate_photos', MigratePhotos),
+    ('/admin/migrate_counters', MigrateCounters),
+    ('/admin/build_summaries', BuildSummaries),
+    ('/admin/index_activity', IndexActivity),
+    ('/admin/reindex_search', search_index.ReindexAll),
+    # bulk imports guestbook for its models; webapp2 imports it on first use
+    ('/admin/export', 'bulk.Export'),
+    ('/admin/import', 'bulk.Import'),
+    ('/tasks/notify_reply', notifications.NotifyReply),
+    ('/tasks/send_digest', notifications.SendDigest),
+    ('/tasks/render_photo', RenderPhoto),
+    ('/tasks/render_avatar', RenderAvatar),
+    ('/tasks/delete_tree', DeleteTree),
+    ('/tasks/decay_hot', DecayHot),
+    ('/tasks/fold_votes', FoldVotes),
+    ('/tasks/prune_changes', PruneChanges),
+    ('/tasks/index_post', search_index.IndexPost),
+    ('/tasks/export_batch', 'bulk.ExportBatch'),
+    ('/tasks/import_batch', 'bulk.ImportBatch'),
 ], debug=True)
+
+# Served by app.yaml: the app behind the write rate limits, with a sample of
+# its requests instrumented
+instrumented_app = instrumentation.Middleware(ratelimit.Middleware(app))
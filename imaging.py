@@ -0,0 +1,42 @@
+# imaging.py
+#
+# Background image renditions.  Uploads store the original once in the
+# blobstore; each rendition listed here is then produced by its own task
+# straight from the original, so the tasks run in parallel and the upload
+# request never waits on the images service.  Only those tasks import the
+# images API.
+
+from google.appengine.api import taskqueue
+
+
+QUEUE_NAME = 'images'
+
+# name: (width, height, crop_to_fit, output encoding name); a height of 0
+# keeps the aspect ratio
+RENDITIONS = {
+    'avatar': (32, 32, True, 'PNG'),
+    'avatar_64': (64, 64, True, 'PNG'),
+    'thumb': (130, 160, False, 'PNG'),
+    'display': (400, 0, False, 'JPEG'),
+    'retina': (800, 0, False, 'JPEG'),
+}
+
+# Renditions produced for comment photos and for avatars
+PHOTO_RENDITIONS = ['thumb', 'display', 'retina']
+AVATAR_RENDITIONS = ['avatar', 'avatar_64']
+
+
+def queue_renditions_async(url, names, **params):
+    """Enqueue one rendering task per rendition name; returns the RPC."""
+    tasks = [taskqueue.Task(url=url, params=dict(params, rendition=name))
+             for name in names]
+    return taskqueue.Queue(QUEUE_NAME).add_async(tasks)
+
+
+def render(blob_key, name):
+    """Return the bytes of a rendition of an original stored in the blobstore."""
+    from google.appengine.api import images
+    width, height, crop_to_fit, output_encoding = RENDITIONS[name]
+    image = images.Image(blob_key=blob_key)
+    image.resize(width=width, height=height, crop_to_fit=crop_to_fit)
+    return image.execute_transforms(output_encoding=getattr(images, output_encoding))
@@ -0,0 +1,264 @@
+# instrumentation.py
+#
+# Per-request RPC and timing instrumentation.  Middleware wraps the WSGI app
+# and, for a sample of requests, times every App Engine API call (datastore,
+# memcache, urlfetch, mail, ...) through apiproxy hooks, each template render
+# and the whole request.  A sampled request is logged as one JSON line and
+# answered with a Server-Timing header.  Admins can add ?_timing=1 to any
+# page to sample it and get the numbers as an overlay, and /_stats sums up
+# the requests this instance sampled recently.  Requests that are not
+# sampled only pay for one random() call and the hooks' thread-local check.
+
+import cgi
+import collections
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import users
+
+import jinja2
+
+
+# Fraction of requests instrumented; set it in app.yaml env_variables
+SAMPLE_RATE = float(os.environ.get('INSTRUMENTATION_SAMPLE_RATE', 0))
+
+STATS_PATH = '/_stats'
+
+# /_stats covers the sampled requests of this long ago, at most MAX_RECORDS
+STATS_WINDOW = 10 * 60
+MAX_RECORDS = 2000
+
+# Rows shown per /_stats table, and slowest calls kept per request
+STATS_ROWS = 20
+SLOWEST_CALLS = 5
+
+_local = threading.local()
+_records = collections.deque(maxlen=MAX_RECORDS)
+_records_lock = threading.Lock()
+
+
+def current():
+    """Return the RequestStats of the request being sampled, or None."""
+    return getattr(_local, 'stats', None)
+
+
+class RequestStats(object):
+    """The API calls and template renders of one sampled request"""
+
+    def __init__(self, path):
+        self.path = path
+        self.start = time.time()
+        self.total_ms = None
+        self.status = None
+        self._pending = {}
+        # ('service.Method', milliseconds) and (template name, milliseconds)
+        self.calls = []
+        self.templates = []
+
+    def call_started(self, request):
+        self._pending[id(request)] = time.time()
+
+    def call_finished(self, service, call, request):
+        start = self._pending.pop(id(request), None)
+        if start is not None:
+            self.calls.append(('%s.%s' % (service, call), (time.time() - start) * 1000))
+
+    def finish(self, status):
+        self.status = int(status.split(' ', 1)[0])
+        self.total_ms = (time.time() - self.start) * 1000
+
+    def services(self):
+        """Return {service: [calls, milliseconds]} of the API calls made."""
+        services = collections.OrderedDict()
+        for name, ms in self.calls:
+            totals = services.setdefault(name.split('.', 1)[0], [0, 0.0])
+            totals[0] += 1
+            totals[1] += ms
+        return services
+
+    def server_timing(self):
+        """Return the value of the Server-Timing response header."""
+        metrics = ['%s;dur=%.1f;desc="%d calls"' % (service, ms, count)
+                   for service, (count, ms) in self.services().items()]
+        if self.templates:
+            metrics.append('templates;dur=%.1f;desc="%d renders"' % (
+                sum(ms for _, ms in self.templates), len(self.templates)))
+        metrics.append('total;dur=%.1f' % self.total_ms)
+        return ', '.join(metrics)
+
+    def record(self):
+        """Return the JSON-able summary that is logged and kept for /_stats."""
+        return {
+            'time': self.start,
+            'path': self.path,
+            'status': self.status,
+            'total_ms': round(self.total_ms, 1),
+            'services': dict((service, {'calls': count, 'ms': round(ms, 1)})
+                             for service, (count, ms) in self.services().items()),
+            'templates': [[name, round(ms, 1)] for name, ms in self.templates],
+            'slowest_calls': [[name, round(ms, 1)] for name, ms in
+                              sorted(self.calls, key=lambda call: -call[1])[:SLOWEST_CALLS]],
+        }
+
+
+def _before_call(service, call, request, response):
+    stats = current()
+    if stats is not None:
+        stats.call_started(request)
+
+
+def _after_call(service, call, request, response):
+    stats = current()
+    if stats is not None:
+        stats.call_finished(service, call, request)
+
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('instrumentation', _before_call)
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('instrumentation', _after_call)
+
+
+class TimedTemplate(jinja2.Template):
+    """Template class that times renders of sampled requests
+
+    Set as an Environment's template_class.
+    """
+
+    def render(self, *args, **kwargs):
+        stats = current()
+        if stats is None:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        start = time.time()
+        try:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        finally:
+            stats.templates.append((self.name, (time.time() - start) * 1000))
+
+
+def recent_records(window=STATS_WINDOW):
+    """Return the records of the requests sampled in the last window seconds."""
+    cutoff = time.time() - window
+    with _records_lock:
+        return [record for record in _records if record['time'] >= cutoff]
+
+
+def summarize(records):
+    """Return (hottest routes, slowest calls) over sampled request records.
+
+    Routes are (path, requests, mean ms, max ms, mean API calls) by request
+    count; calls are (service.Method, ms, path) slowest first.
+    """
+    routes = {}
+    calls = []
+    for record in records:
+        route = routes.setdefault(record['path'], [0, 0.0, 0.0, 0])
+        route[0] += 1
+        route[1] += record['total_ms']
+        route[2] = max(route[2], record['total_ms'])
+        route[3] += sum(service['calls'] for service in record['services'].values())
+        calls.extend((name, ms, record['path']) for name, ms in record['slowest_calls'])
+    hottest = sorted(((path, count, total / count, slowest, float(rpcs) / count)
+                      for path, (count, total, slowest, rpcs) in routes.items()),
+                     key=lambda route: -route[1])
+    slowest = sorted(calls, key=lambda call: -call[1])
+    return hottest[:STATS_ROWS], slowest[:STATS_ROWS]
+
+
+def _overlay(stats):
+    parts = ['total %.1f ms' % stats.total_ms]
+    parts.extend('%s %d calls %.1f ms' % (service, count, ms)
+                 for service, (count, ms) in stats.services().items())
+    parts.extend('%s %.1f ms' % (name, ms) for name, ms in stats.templates)
+    return ('<div style="position:fixed; bottom:0; right:0; z-index:10000; padding:4px 8px; '
+            'background:#222; color:#eee; opacity:0.9; font:12px monospace;">%s</div>'
+            % ' | '.join(cgi.escape(part) for part in parts))
+
+
+class Middleware(object):
+    """WSGI middleware instrumenting a sample of the wrapped app's requests."""
+
+    def __init__(self, app, sample_rate=SAMPLE_RATE):
+        self.app = app
+        self.sample_rate = sample_rate
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path == STATS_PATH:
+            return self.stats_page(start_response)
+
+        overlay = ('_timing=1' in environ.get('QUERY_STRING', '') and
+                   users.is_current_user_admin())
+        if not overlay and (not self.sample_rate or random.random() >= self.sample_rate):
+            return self.app(environ, start_response)
+
+        stats = _local.stats = RequestStats(path)
+        response = {}
+
+        def timed_start_response(status, headers, exc_info=None):
+            stats.finish(status)
+            headers = list(headers) + [('Server-Timing', stats.server_timing())]
+            if overlay:
+                # Headers wait for the body, which gets the overlay added
+                response['status'], response['headers'] = status, headers
+                return lambda data: None
+            return start_response(status, headers, exc_info)
+
+        try:
+            body = self.app(environ, timed_start_response)
+            if overlay:
+                body = self._add_overlay(stats, body, response, start_response)
+        finally:
+            _local.stats = None
+
+        record = stats.record()
+        logging.info('request stats %s', json.dumps(record, sort_keys=True))
+        with _records_lock:
+            _records.append(record)
+        return body
+
+    def _add_overlay(self, stats, body, response, start_response):
+        content = ''.join(body)
+        if hasattr(body, 'close'):
+            body.close()
+        headers = [(name, value) for name, value in response['headers']
+                   if name.lower() != 'content-length']
+        content_type = dict((name.lower(), value) for name, value in headers).get('content-type', '')
+        if content_type.startswith('text/html'):
+            index = content.rfind('</body>')
+            if index < 0:
+                index = len(content)
+            content = content[:index] + _overlay(stats) + content[index:]
+        headers.append(('Content-Length', str(len(content))))
+        start_response(response['status'], headers)
+        return [content]
+
+    def stats_page(self, start_response):
+        """Serve the hottest routes and slowest API calls to admins."""
+        if not users.is_current_user_admin():
+            start_response('403 Forbidden', [('Content-Type', 'text/plain')])
+            return ['Forbidden']
+        records = recent_records()
+        hottest, slowest = summarize(records)
+        rows = ['<h2>%d sampled requests in the last %d minutes on this instance</h2>'
+                % (len(records), STATS_WINDOW // 60),
+                '<h3>Hottest routes</h3><table border="1" cellpadding="4">'
+                '<tr><th>path</th><th>requests</th><th>mean ms</th><th>max ms</th>'
+                '<th>API calls</th></tr>']
+        rows.extend('<tr><td>%s</td><td>%d</td><td>%.1f</td><td>%.1f</td><td>%.1f</td></tr>'
+                    % (cgi.escape(path), count, mean, worst, rpcs)
+                    for path, count, mean, worst, rpcs in hottest)
+        rows.append('</table><h3>Slowest API calls</h3><table border="1" cellpadding="4">'
+                    '<tr><th>call</th><th>ms</th><th>path</th></tr>')
+        rows.extend('<tr><td>%s</td><td>%.1f</td><td>%s</td></tr>'
+                    % (cgi.escape(name), ms, cgi.escape(path))
+                    for name, ms, path in slowest)
+        rows.append('</table>')
+        content = '<html><body>%s</body></html>' % ''.join(rows)
+        start_response('200 OK', [('Content-Type', 'text/html; charset=utf-8'),
+                                  ('Cache-Control', 'private, no-store'),
+                                  ('Content-Length', str(len(content)))])
+        return [content]
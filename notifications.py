@@ -0,0 +1,150 @@
+# notifications.py
+#
+# Reply notification emails.  Posting a reply only enqueues a task; that
+# task records the reply as pending for its recipient and schedules one
+# digest task per recipient per time window, which sends a single email
+# covering every reply that arrived in the window.  Task names make both
+# steps idempotent, and a failed send is retried by the queue (queue.yaml).
+# Only the digest task imports the mail API.
+
+import hashlib
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import webapp2
+
+
+QUEUE_NAME = 'notifications'
+
+SENDER_ADDRESS = 'glengoffin3@gmail.com'
+SITE_URL = 'http://medreach-1080.appspot.com'
+
+# Replies to one recipient within this many seconds share a single email
+DIGEST_WINDOW = 10 * 60
+
+# Most replies quoted in full in one digest email
+DIGEST_SIZE = 10
+
+
+class PendingReply(ndb.Model):
+    """A reply waiting for its recipient's next digest email
+
+    Stored under recipient_key() and keyed by the reply's greeting key, so a
+    retried task rewrites the same entity.
+    """
+    discussion_key = ndb.StringProperty(indexed=False)
+    discussion_title = ndb.StringProperty(indexed=False)
+    author_email = ndb.StringProperty(indexed=False)
+    content = ndb.TextProperty()
+    date = ndb.DateTimeProperty(auto_now_add=True)
+
+
+def recipient_key(email):
+    """Return the entity group root of one recipient's pending replies."""
+    return ndb.Key('NotificationRecipient', email)
+
+
+@ndb.tasklet
+def _add_task_async(task):
+    """Add a named task; return False if a task of that name already ran."""
+    try:
+        yield taskqueue.Queue(QUEUE_NAME).add_async(task)
+    except taskqueue.TaskAlreadyExistsError:
+        raise ndb.Return(True)
+    except taskqueue.TombstonedTaskError:
+        raise ndb.Return(False)
+    raise ndb.Return(True)
+
+
+def queue_reply_async(recipient, discussion, greeting):
+    """Enqueue an email to recipient about a new reply to their discussion."""
+    return _add_task_async(taskqueue.Task(
+        url='/tasks/notify_reply',
+        name='reply-' + greeting.key.urlsafe(),
+        params={
+            'recipient': recipient,
+            'discussion_key': discussion.key.urlsafe(),
+            'discussion_title': discussion.title or '',
+            'greeting_key': greeting.key.urlsafe(),
+            'author_email': greeting.author.email,
+            'content': greeting.content or '',
+        }))
+
+
+def _schedule_digest(recipient, after=None):
+    """Schedule the digest email for the recipient's current time window.
+
+    A digest task passes its own window as after, so the one scheduled is
+    always a later one.
+    """
+    now = time.time()
+    window = int(now) // DIGEST_WINDOW
+    if after is not None:
+        window = max(window, after + 1)
+    recipient_hash = hashlib.sha1(recipient.encode('utf-8')).hexdigest()
+    # If this window's digest already ran, the reply goes out in the next one
+    for offset in (0, 1):
+        task = taskqueue.Task(
+            url='/tasks/send_digest',
+            name='digest-%s-%d' % (recipient_hash, window + offset),
+            params={'recipient': recipient, 'window': window + offset},
+            countdown=(window + offset + 1) * DIGEST_WINDOW - now)
+        if _add_task_async(task).get_result():
+            return
+
+
+def _digest_message(replies):
+    """Return the subject and body of a digest email for pending replies."""
+    if len(replies) == 1:
+        subject = "%s Replied to You on MedReach" % replies[0].author_email
+    else:
+        subject = "%d New Replies to You on MedReach" % len(replies)
+
+    paragraphs = []
+    for reply in replies[:DIGEST_SIZE]:
+        url_link = SITE_URL + '/discussion?discussion_key=' + reply.discussion_key
+        paragraphs.append(
+            """%s has responded to your post titled, "%s"  \nHere's what they said: "%s"  \nVisit the site %s."""
+            % (reply.author_email, reply.discussion_title, reply.content, url_link))
+    if len(replies) > DIGEST_SIZE:
+        paragraphs.append('... and %d more replies on %s.' % (len(replies) - DIGEST_SIZE, SITE_URL))
+    return subject, '\n\n'.join(paragraphs)
+
+
+class NotifyReply(webapp2.RequestHandler):
+    """Task: record a reply as pending and make sure its digest is scheduled."""
+    def post(self):
+        recipient = self.request.get('recipient')
+        PendingReply(
+            key=ndb.Key(PendingReply, self.request.get('greeting_key'),
+                        parent=recipient_key(recipient)),
+            discussion_key=self.request.get('discussion_key'),
+            discussion_title=self.request.get('discussion_title'),
+            author_email=self.request.get('author_email'),
+            content=self.request.get('content')).put()
+        _schedule_digest(recipient)
+
+
+class SendDigest(webapp2.RequestHandler):
+    """Task: send one email covering a recipient's pending replies.
+
+    A failed send raises, so the queue retries the task and the replies stay
+    pending until it succeeds.  Replies recorded while it ran found this
+    task already scheduled, so any left over get the next window's digest.
+    """
+    def post(self):
+        from google.appengine.api import mail
+        recipient = self.request.get('recipient')
+        query = PendingReply.query(ancestor=recipient_key(recipient))
+        replies = query.fetch()
+        if replies:
+            replies.sort(key=lambda reply: reply.date)
+            subject, body = _digest_message(replies)
+            mail.send_mail(sender=SENDER_ADDRESS, to=recipient, subject=subject, body=body)
+            ndb.delete_multi([reply.key for reply in replies])
+
+        if query.get(keys_only=True):
+            window = self.request.get('window')
+            _schedule_digest(recipient, int(window) if window else None)
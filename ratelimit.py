@@ -0,0 +1,128 @@
+# ratelimit.py
+#
+# Rate limits on the write endpoints.  Middleware checks each request to a
+# limited route before it reaches its handler, so a client over budget gets
+# a 429 with Retry-After for the price of two memcache calls, ahead of any
+# datastore, blobstore or image work.  Every route has its own budget per
+# signed-in user and, looser as people share addresses, per client IP.
+# Blobstore upload callbacks (/upload_img, /upload_avatar) are not limited,
+# as their blob is already stored by the time they are called; uploads are
+# limited where their URLs are issued instead: /upload_urls for photos,
+# charged a token per URL, and /settings for avatars.
+#
+# A budget is a bucket of tokens refilled over its period.  Each request
+# takes one (or one per item, see ITEM_COSTS) with a memcache incr on the
+# counter of the current period window; the previous window's count is
+# weighed in by how much of it the last period still covers, so the refill
+# is smooth and a burst across a window boundary cannot spend two budgets.  Counting with incr needs no
+# read-modify-write, and if memcache is unavailable requests go through.
+
+import logging
+import math
+import time
+import urlparse
+
+from google.appengine.api import memcache
+from google.appengine.api import users
+
+
+# Route -> (requests per user, requests per IP address, period in seconds)
+LIMITS = {
+    '/post_new': (5, 20, 10 * 60),
+    '/sign': (20, 60, 60),
+    '/vote': (60, 200, 60),
+    '/upload_urls': (20, 60, 60),
+    # Each view of the settings page issues an avatar upload URL
+    '/settings': (20, 60, 60),
+}
+
+# Routes charged a token per item a request asks for: route -> (query
+# parameter giving the number of items, most items one request can take)
+ITEM_COSTS = {
+    '/upload_urls': ('count', 3),
+}
+
+
+def _counter_key(route, client, window):
+    return 'ratelimit:%s:%s:%d' % (route, client, window)
+
+
+def _wait(taken, previous, limit, period, elapsed):
+    """Return the seconds until a bucket has a token again, 0 if it has one now."""
+    weight = 1 - elapsed / period
+    if taken + previous * weight <= limit:
+        return 0
+    if taken > limit:
+        # This window is spent; in the next one its count still weighs in
+        # until enough of it has slid out of the period
+        return period - elapsed + period * (1 - float(limit) / taken)
+    # The previous window's share drains by previous/period a second
+    return (taken + previous * weight - limit) * period / previous
+
+
+def check(route, user_id, address, cost=1, now=None):
+    """Take cost tokens from a route's buckets for a client.
+
+    Returns 0 if the request may go ahead, else the whole seconds to wait.
+    """
+    if route not in LIMITS:
+        return 0
+    per_user, per_address, period = LIMITS[route]
+    now = time.time() if now is None else now
+    window = int(now // period)
+    elapsed = now - window * period
+
+    buckets = [('ip:' + address, per_address)]
+    if user_id:
+        buckets.append(('user:' + user_id, per_user))
+    client = memcache.Client()
+    taken = client.offset_multi(
+        dict((_counter_key(route, name, window), cost) for name, _ in buckets),
+        initial_value=0) or {}
+    previous = client.get_multi(
+        [_counter_key(route, name, window - 1) for name, _ in buckets])
+
+    wait = 0
+    for name, limit in buckets:
+        count = taken.get(_counter_key(route, name, window))
+        if count is None:
+            continue
+        wait = max(wait, _wait(count, previous.get(_counter_key(route, name, window - 1), 0),
+                               limit, float(period), elapsed))
+    return int(math.ceil(wait))
+
+
+def request_cost(route, environ):
+    """Return the tokens a request to a limited route takes, at least 1."""
+    if route not in ITEM_COSTS:
+        return 1
+    param, most = ITEM_COSTS[route]
+    values = urlparse.parse_qs(environ.get('QUERY_STRING', '')).get(param)
+    try:
+        return min(max(int(values[0]), 1), most)
+    except (TypeError, ValueError):
+        return 1
+
+
+class Middleware(object):
+    """WSGI middleware answering requests over their route's budget with 429."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        route = environ.get('PATH_INFO', '')
+        if route in LIMITS:
+            user = users.get_current_user()
+            wait = check(route, user.user_id() if user else None,
+                         environ.get('REMOTE_ADDR', ''), request_cost(route, environ))
+            if wait:
+                logging.info('Rate limited %s for %s, retry after %ds', route,
+                             user.email() if user else environ.get('REMOTE_ADDR'), wait)
+                start_response('429 Too Many Requests', [
+                    ('Content-Type', 'text/plain'),
+                    ('Retry-After', str(wait)),
+                    ('Cache-Control', 'private, no-store'),
+                ])
+                return ['Too many requests, please try again in %d seconds.\n' % wait]
+        return self.app(environ, start_response)
@@ -0,0 +1,179 @@
+# search_index.py
+#
+# Full-text search over discussions and comments with the App Engine Search
+# API, which the dev server stubs locally.  Each Discussion and Greeting is
+# one document whose id is its urlsafe key.  Writes only enqueue a task that
+# re-reads the entity and re-indexes it, so posting never waits on the
+# search service and a failed update is retried by the queue (queue.yaml).
+# The Search API itself is only imported by the code that talks to it.
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import webapp2
+
+
+INDEX_NAME = 'posts'
+QUEUE_NAME = 'search'
+
+# Search results per page, by default and at most
+RESULTS_PER_PAGE = 20
+MAX_RESULTS_PER_PAGE = 100
+
+# Most category facet values returned with a page of results
+FACET_VALUES = 10
+
+# Comments re-indexed per task when a discussion's title or category changes
+REINDEX_BATCH_SIZE = 100
+
+# Fields handed back with each result
+RETURNED_FIELDS = ['kind', 'discussion_key', 'discussion_title', 'author',
+                   'content', 'date']
+
+
+def _index():
+    from google.appengine.api import search
+    return search.Index(name=INDEX_NAME)
+
+
+def _discussion_key(key):
+    return ndb.Key(pairs=key.pairs()[:1])
+
+
+def _document(entity, discussion):
+    """Build the search document of a discussion or one of its comments."""
+    from google.appengine.api import search
+    is_discussion = entity.key == discussion.key
+    if is_discussion:
+        author = discussion.owner
+    else:
+        author = entity.author
+    fields = [
+        search.AtomField(name='kind', value='discussion' if is_discussion else 'comment'),
+        search.AtomField(name='discussion_key', value=discussion.key.urlsafe()),
+        # Shown with every result; as an atom it only matches the exact title,
+        # so a title's words are searched through the discussion's title field
+        search.AtomField(name='discussion_title', value=(discussion.title or '')[:500]),
+        search.AtomField(name='author', value=author.email if author else None),
+        search.TextField(name='content', value=entity.content),
+        search.DateField(name='date', value=entity.date),
+    ]
+    if is_discussion:
+        fields.append(search.TextField(name='title', value=discussion.title))
+    facets = []
+    if discussion.medical_category:
+        facets.append(search.AtomFacet(name='category', value=discussion.medical_category))
+    return search.Document(doc_id=entity.key.urlsafe(), fields=fields, facets=facets)
+
+
+def _update_task(key, cascade=False, cursor=None):
+    params = {'key': key.urlsafe()}
+    if cascade:
+        params['cascade'] = 1
+    if cursor:
+        params['cursor'] = cursor.urlsafe()
+    return taskqueue.Task(url='/tasks/index_post', params=params)
+
+
+def queue_update_async(key, cascade=False):
+    """Enqueue re-indexing of a discussion or comment; returns the RPC.
+
+    With cascade, a discussion's comments are re-indexed too, as they carry
+    its title and category.
+    """
+    return taskqueue.Queue(QUEUE_NAME).add_async(_update_task(key, cascade))
+
+
+@ndb.tasklet
+def remove_async(keys):
+    """Drop deleted discussions and comments from the index."""
+    if keys:
+        future = _index().delete_async([key.urlsafe() for key in keys])
+        # Search futures aren't ndb futures, but the UserRPC they wrap can be
+        # waited on without blocking other tasklets
+        yield future._rpc
+        future.get_result()
+
+
+def search_posts(query_string, category=None, limit=RESULTS_PER_PAGE, cursor=None):
+    """Run a search and return (results, category facets, next cursor).
+
+    Each result is a dict of RETURNED_FIELDS; facets are (category, count)
+    pairs over every match, ignoring the category refinement.  With a
+    category, the facets come from a second, unrefined query run alongside.
+    """
+    from google.appengine.api import search
+    return_facets = [search.FacetRequest(name='category', value_limit=FACET_VALUES)]
+    options = search.QueryOptions(
+        limit=limit,
+        cursor=search.Cursor(web_safe_string=cursor) if cursor else search.Cursor(),
+        returned_fields=RETURNED_FIELDS)
+    if category:
+        found_future = _index().search_async(search.Query(
+            query_string=query_string, options=options,
+            facet_refinements=[search.FacetRefinement(name='category', value=category)]))
+        facet_future = _index().search_async(search.Query(
+            query_string=query_string,
+            options=search.QueryOptions(limit=1, ids_only=True),
+            return_facets=return_facets))
+        found, facet_found = found_future.get_result(), facet_future.get_result()
+    else:
+        found = facet_found = _index().search(search.Query(
+            query_string=query_string, options=options, return_facets=return_facets))
+
+    results = []
+    for document in found.results:
+        result = dict((field.name, field.value) for field in document.fields)
+        result['doc_id'] = document.doc_id
+        results.append(result)
+    facets = [(value.label, value.count)
+              for facet in facet_found.facets if facet.name == 'category'
+              for value in facet.values]
+    next_cursor = found.cursor.web_safe_string if found.cursor else None
+    return results, facets, next_cursor
+
+
+class IndexPost(webapp2.RequestHandler):
+    """Task: re-index one discussion or comment, or drop it if it is gone."""
+    def post(self):
+        key = ndb.Key(urlsafe=self.request.get('key'))
+        entity, discussion = ndb.get_multi([key, _discussion_key(key)])
+        if entity is None or discussion is None:
+            remove_async([key]).get_result()
+            return
+
+        documents = [_document(entity, discussion)]
+        if self.request.get('cascade'):
+            cursor = None
+            if self.request.get('cursor'):
+                cursor = ndb.Cursor(urlsafe=self.request.get('cursor'))
+            comments, next_cursor, more = ndb.Query(kind='Greeting', ancestor=key).fetch_page(
+                REINDEX_BATCH_SIZE, start_cursor=cursor)
+            documents.extend(_document(comment, discussion) for comment in comments)
+            if more and next_cursor:
+                taskqueue.Queue(QUEUE_NAME).add(_update_task(key, True, next_cursor))
+        _index().put(documents)
+
+
+class ReindexAll(webapp2.RequestHandler):
+    """One-off indexing of every existing discussion with its comments.
+
+    Walks Discussion in batches, chaining itself through the task queue with
+    a cursor; each discussion's comments are indexed by its own tasks.
+    """
+    def get(self):
+        self.post()
+
+    def post(self):
+        cursor = None
+        if self.request.get('cursor'):
+            cursor = ndb.Cursor(urlsafe=self.request.get('cursor'))
+        keys, next_cursor, more = ndb.Query(kind='Discussion').fetch_page(
+            REINDEX_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        if keys:
+            taskqueue.Queue(QUEUE_NAME).add([_update_task(key, cascade=True) for key in keys])
+
+        if more and next_cursor:
+            taskqueue.add(url='/admin/reindex_search',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.write('Queued indexing of %d discussions' % len(keys))